@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for mynamer.FileNamer person name recognition.
+
+Compares the old loop over every PersonName with the compiled NameMatcher
+on made-up names and titles, checks that both give the same answers, and
+times name_for() as a whole.
+
+	python bench/bench_namer.py --names 500 --posts 5000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mynamer
+
+
+class Obj(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+def word(rnd, lo=3, hi=8):
+	return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(lo, hi)))
+
+
+def make_data(rnd, n_names, n_posts, hit_rate):
+	names = [ "{} {}".format(word(rnd).title(), word(rnd).title()) for _ in range(n_names) ]
+	authors = [ word(rnd, 5, 12) for _ in range(200) ]
+	subs = [ word(rnd, 4, 10) for _ in range(100) ]
+	posts = []
+	for _ in range(n_posts):
+		title = ' '.join(word(rnd, 2, 9) for _ in range(rnd.randint(4, 14)))
+		if rnd.random() < hit_rate:
+			name = rnd.choice(names)
+			title = "{} {} {}".format(title[:20], name.replace(' ', rnd.choice(['', ' ', '-', '_'])), title[20:])
+		posts.append(Obj(title=title, author=Obj(name=rnd.choice(authors)),
+						 subreddit=Obj(display_name=rnd.choice(subs)), created=0))
+	return (names, posts)
+
+
+def old_recognize(names, title, author, sub_name):
+	'''The loop FileNamer used before NameMatcher.'''
+	for name in names:
+		if name.is_name(title) or name.is_name(author) or name.is_name(sub_name):
+			return name.name
+	return None
+
+
+def timed(label, n, fn):
+	start = time.perf_counter()
+	result = fn()
+	elapsed = time.perf_counter() - start
+	print ("{:<28} {:10.2f} us/post".format(label, elapsed / n * 1e6))
+	return (result, elapsed)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--names', type=int, default=500)
+	parser.add_argument('--posts', type=int, default=5000)
+	parser.add_argument('--hit-rate', type=float, default=0.2, help="share of titles containing a name")
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+
+	(names, posts) = make_data(random.Random(args.seed), args.names, args.posts, args.hit_rate)
+	namer = mynamer.FileNamer({ 'following': [], 'subusingnames': [], 'names': names })
+	fields = [ (p.title, p.author.name, p.subreddit.display_name) for p in posts ]
+	print ("{} names, {} posts".format(len(names), len(posts)))
+
+	(old, old_time) = timed("loop over names", len(posts),
+							lambda: [ old_recognize(namer._names, *f) for f in fields ])
+	(new, new_time) = timed("compiled matcher", len(posts),
+							lambda: [ namer._recognize_person_name(*f) for f in fields ])
+	timed("name_for", len(posts), lambda: [ namer.name_for(p) for p in posts ])
+
+	mismatches = sum(1 for (a, b) in zip(old, new) if a != b)
+	print ("speed up {:.1f}x, {} of {} answers differ".format(old_time / new_time, mismatches, len(posts)))
+	return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+End to end benchmark of script.save_posts against local stand-ins for
+reddit and the media hosts (see fixtures.py), so runs can be compared
+before and after a change.
+
+	python bench/bench_run.py --posts 300 --workers 8 --latency 0.05 --bandwidth-kb 4096
+
+Reports posts per second, MB per second received, per-post latency
+percentiles and the peak RSS of this process.  --repeat runs save_posts
+again over the same directory and state, which measures a run where
+everything has been seen before (with --incremental, one that stops at
+the first post the last run listed).  --json also writes the numbers to a file.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fixtures
+import metrics
+import mynamer
+import script
+import statestore
+
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Kilobytes on Linux, bytes on macOS.
+	return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def disk_bytes(directory):
+	total = 0
+	for (root, dirs, files) in os.walk(directory):
+		for name in files:
+			if not name.startswith('.'):
+				total += os.path.getsize(os.path.join(root, name))
+	return total
+
+
+def parse_mix(text):
+	if not text:
+		return None
+	mix = {}
+	for part in text.split(','):
+		(kind, _, weight) = part.partition('=')
+		if kind not in fixtures.DEFAULT_MIX:
+			raise SystemExit("unknown post kind '{}', use {}".format(kind, ", ".join(fixtures.DEFAULT_MIX)))
+		mix[kind] = int(weight or 1)
+	return mix
+
+
+def run_once(args, R, server, save_dir, state):
+	'''One call of save_posts.  Returns a dict of results.'''
+	latencies = []
+	statuses = {}
+	errors = []
+	real_download_post = script.download_post
+
+	def timed_download_post(sp, *a, **kw):
+		start = time.perf_counter()
+		try:
+			return real_download_post(sp, *a, **kw)
+		finally:
+			latencies.append(time.perf_counter() - start)
+			statuses[sp.status_code] = statuses.get(sp.status_code, 0) + 1
+			if not sp.is_saved:
+				errors.append("{} ({}): {}".format(sp.submission.url, sp.status_code, sp.error_message))
+
+	run_metrics = metrics.Metrics()
+	pool_size = script.pool_size_for(args.workers, args.segments)
+	transport = script.Transport(pool_size=pool_size, metrics=run_metrics)
+	fixtures.point_at(transport, server, pool_size=pool_size)
+	namer = mynamer.FileNamer({ 'following': [], 'subusingnames': [], 'names': [] })
+	context = script.DownloadContext(transport=transport, state=state, segments=args.segments,
+									 segment_threshold_mb=args.segment_threshold_mb)
+
+	requests_before = server.requests
+	pages_before = R.pages
+	bytes_before = server.bytes_sent
+	disk_before = disk_bytes(save_dir)
+	out = None if args.verbose else open(os.devnull, 'w')
+	script.download_post = timed_download_post
+	start = time.perf_counter()
+	try:
+		with contextlib.redirect_stdout(out or sys.stdout), contextlib.redirect_stderr(out or sys.stderr):
+			script.save_posts(R, R.username, save_dir, namer, context, limit=args.limit, is_unsave=args.unsave,
+							  is_expirmental=True, workers=args.workers, unsave_rate=0,
+							  incremental=args.incremental)
+	finally:
+		elapsed = time.perf_counter() - start
+		script.download_post = real_download_post
+		transport.close()
+		if out is not None:
+			out.close()
+
+	received = server.bytes_sent - bytes_before
+	return {
+		'seconds': elapsed,
+		'posts': len(latencies),
+		'saved': statuses.get(script.SavedPost.STATUS_SAVED, 0),
+		'failed': len(errors),
+		'posts_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+		'requests': server.requests - requests_before,
+		'pages': R.pages - pages_before,
+		'mb_received': received / 1e6,
+		'mb_per_sec': received / 1e6 / elapsed if elapsed else 0.0,
+		'mb_written': (disk_bytes(save_dir) - disk_before) / 1e6,
+		'p50_ms': percentile(latencies, 50) * 1000,
+		'p99_ms': percentile(latencies, 99) * 1000,
+		'max_ms': max(latencies) * 1000 if latencies else 0.0,
+		'peak_rss_mb': peak_rss_mb(),
+		'errors': errors[:10],
+		'metrics': run_metrics.summary(),
+	}
+
+
+def report(n, result):
+	print ("run {}: {posts} posts ({saved} saved, {failed} failed) in {seconds:.2f}s, "
+		   "{requests} requests, {pages} listing pages".format(n, **result))
+	print ("    {posts_per_sec:8.1f} posts/s   {mb_per_sec:8.1f} MB/s   "
+		   "{mb_received:.1f} MB received, {mb_written:.1f} MB written".format(**result))
+	print ("    latency p50 {p50_ms:.0f} ms   p99 {p99_ms:.0f} ms   max {max_ms:.0f} ms   "
+		   "peak RSS {peak_rss_mb:.0f} MB".format(**result))
+	for error in result['errors']:
+		print ("    " + error)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--posts', type=int, default=200, help="saved posts in the fake listing")
+	parser.add_argument('--mix', help="post kinds and weights, e.g. image=3,redgifs=1 (default: {})".format(
+		",".join("{}={}".format(k, v) for (k, v) in fixtures.DEFAULT_MIX.items())))
+	parser.add_argument('--image-kb', type=int, default=300, help="average image size")
+	parser.add_argument('--video-kb', type=int, default=4096, help="average video size")
+	parser.add_argument('--album-size', type=int, default=4, help="images per album and gallery")
+	parser.add_argument('--latency', type=float, default=0.02, help="seconds before each response")
+	parser.add_argument('--bandwidth-kb', type=int, default=0, help="KB/s per response, 0 for no cap")
+	parser.add_argument('--page-latency', type=float, default=0.2, help="seconds per page of 100 saved posts")
+	parser.add_argument('--workers', type=int, default=4)
+	parser.add_argument('--segments', type=int, default=4)
+	parser.add_argument('--segment-threshold-mb', type=float, default=32)
+	parser.add_argument('--limit', type=int, default=0)
+	parser.add_argument('--unsave', action='store_true', help="unsave posts as they are downloaded")
+	parser.add_argument('--repeat', type=int, default=1, help="runs over the same directory and state")
+	parser.add_argument('--incremental', action='store_true', help="stop listing where the last run started")
+	parser.add_argument('--dir', help="save here and keep the files (default: a temporary directory)")
+	parser.add_argument('--json', help="write the results to this file")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--verbose', action='store_true', help="show save_posts output")
+	args = parser.parse_args()
+
+	corpus = fixtures.Corpus(args.posts, parse_mix(args.mix), args.image_kb, args.video_kb,
+							 args.album_size, args.seed)
+	server = fixtures.LocalServer(corpus.resources, args.latency, args.bandwidth_kb * 1024)
+	R = fixtures.FakeReddit(corpus.posts, page_latency=args.page_latency)
+	save_dir = args.dir or tempfile.mkdtemp(prefix='bench-saved-')
+	os.makedirs(save_dir, exist_ok=True)
+	state = statestore.StateStore(os.path.join(save_dir, '.bench-state.sqlite'),
+								  done_status=script.SavedPost.STATUS_SAVED)
+	print ("{} posts, {} resources, server {}".format(len(corpus.posts), len(corpus.resources), server.url))
+	results = []
+	try:
+		for n in range(1, args.repeat + 1):
+			result = run_once(args, R, server, save_dir, state)
+			report(n, result)
+			results.append(result)
+	finally:
+		state.close()
+		server.close()
+		if not args.dir:
+			shutil.rmtree(save_dir, ignore_errors=True)
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump({ 'args': vars(args), 'runs': results }, f, indent=2)
+	return 1 if any(r['failed'] for r in results) else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+Micro-benchmark for the path a download takes to disk.
+
+Writes several files at once, the way parallel video downloads do, from
+in-memory streams that hand data out a socket read at a time.  Compares:
+
+	old - 64 KB reads, each written as it comes, file grows as it goes
+	new - script.copy_stream through one reused buffer of --buffer-kb,
+		  with the file reserved by script.preallocate_file first
+
+Both write to a .part name and rename it when done.  Reports the time,
+MB/s, write calls per file and, if filefrag is installed, the extents
+per file.  Point --dir at the disk to measure; a temporary directory is
+often tmpfs or SSD and will show little difference in extents.
+
+	python bench/bench_writer.py --files 8 --file-mb 64 --dir /mnt/spinning/tmp
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import script
+
+
+class Source(object):
+	'''A response body: 'size' bytes of 'block' repeated, at most 'recv' per read.'''
+
+	def __init__(self, block, size, recv):
+		self.block = memoryview(block)
+		self.left = size
+		self.recv = recv
+		self.reads = 0
+
+	def _take(self, n):
+		n = min(n, self.recv, self.left, len(self.block))
+		self.left -= n
+		self.reads += 1
+		return n
+
+	def read(self, n):
+		return self.block[:self._take(n)].tobytes()
+
+	def readinto(self, buffer):
+		n = self._take(len(buffer))
+		buffer[:n] = self.block[:n]
+		return n
+
+
+def write_old(source, path, size, fsync):
+	part = path + script.PART_SUFFIX
+	hasher = hashlib.sha256()
+	with open(part, 'wb') as f:
+		for chunk in iter(lambda: source.read(script.COPY_CHUNK_SIZE), b""):
+			hasher.update(chunk)
+			f.write(chunk)
+		if fsync:
+			f.flush()
+			os.fsync(f.fileno())
+	os.replace(part, path)
+
+
+def write_new(source, path, size, fsync, buffer_size, preallocate):
+	part = path + script.PART_SUFFIX
+	hasher = hashlib.sha256()
+	buffer = memoryview(bytearray(buffer_size))
+	with open(part, 'wb') as f:
+		if preallocate:
+			script.preallocate_file(f, size)
+		script.copy_stream(source, f, buffer, hasher)
+		if fsync:
+			f.flush()
+			os.fsync(f.fileno())
+	os.replace(part, path)
+
+
+def extents(path):
+	'''Extents of a file according to filefrag, or None.'''
+	try:
+		out = subprocess.run([ 'filefrag', path ], capture_output=True, text=True, check=True).stdout
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	match = re.search(r'(\d+) extents? found', out)
+	return int(match.group(1)) if match else None
+
+
+def run(name, writer, args, block, directory):
+	size = args.file_mb * 1024 * 1024
+	sources = [ Source(block, size, args.recv_kb * 1024) for _ in range(args.files) ]
+	paths = [ os.path.join(directory, '{}-{}.mp4'.format(name, n)) for n in range(args.files) ]
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=args.files) as pool:
+		for f in [ pool.submit(writer, source, path, size) for (source, path) in zip(sources, paths) ]:
+			f.result()
+	elapsed = time.perf_counter() - start
+	counts = [ extents(path) for path in paths ]
+	counts = [ c for c in counts if c is not None ]
+	total_mb = size * args.files / 1e6
+	print ("{:<4} {:7.2f}s {:8.1f} MB/s   {:7d} writes/file   {}".format(
+		name, elapsed, total_mb / elapsed, sources[0].reads,
+		"{:.1f} extents/file".format(sum(counts) / len(counts)) if counts else "extents unknown"))
+	for path in paths:
+		os.remove(path)
+	return elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--files', type=int, default=8, help="files written at the same time")
+	parser.add_argument('--file-mb', type=int, default=64)
+	parser.add_argument('--recv-kb', type=int, default=256, help="most bytes one read of the source returns")
+	parser.add_argument('--buffer-kb', type=int, default=script.WRITE_BUFFER_SIZE // 1024)
+	parser.add_argument('--no-preallocate', action='store_true')
+	parser.add_argument('--no-fsync', action='store_true', help="leave the data in the page cache")
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--dir', help="write here (default: a temporary directory)")
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp(prefix='bench-writer-', dir=args.dir)
+	block = os.urandom(max(args.buffer_kb, args.recv_kb, 64) * 1024)
+	fsync = not args.no_fsync
+	writers = [
+		('old', lambda source, path, size: write_old(source, path, size, fsync)),
+		('new', lambda source, path, size: write_new(source, path, size, fsync, args.buffer_kb * 1024,
+													 not args.no_preallocate)),
+	]
+	print ("{} files of {} MB at once in {}, {} KB buffer, preallocate {}".format(
+		args.files, args.file_mb, directory, args.buffer_kb, 'off' if args.no_preallocate else 'on'))
+	best = {}
+	try:
+		for _ in range(args.repeat):
+			for (name, writer) in writers:
+				elapsed = run(name, writer, args, block, directory)
+				best[name] = min(best.get(name, elapsed), elapsed)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	print ("best of {}: old {:.2f}s, new {:.2f}s ({:.2f}x)".format(
+		args.repeat, best['old'], best['new'], best['old'] / best['new']))
+
+
+if __name__ == '__main__':
+	main()
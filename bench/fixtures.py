@@ -0,0 +1,359 @@
+"""
+Stand-ins for reddit and the media hosts, so that save_posts can be run
+and timed without a network or an account.
+
+Corpus makes up a saved list spread over the hosts script.py knows, and
+the files and pages those posts lead to.  LocalServer serves them from a
+child process with a set latency and bandwidth, and RewriteAdapter sends
+every request made through a Transport to it, keeping the real host as
+the first part of the path.  FakeReddit hands out the posts the way praw
+does.
+"""
+import io
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests.adapters
+
+
+# Post kinds and the share of the saved list each gets by default.
+DEFAULT_MIX = { 'image': 40, 'video': 10, 'redgifs': 15, 'gfycat': 5,
+				'imgur': 10, 'album': 5, 'gallery': 15 }
+
+MAGIC = { 'image/jpeg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+		  'video/mp4': b'\x00\x00\x00\x18ftypmp42',
+		  'application/zip': b'' }
+
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+SEND_CHUNK = 64 * 1024
+
+WORDS = ("sunset lake morning city street forest dog cat beach night rain snow "
+		 "mountain coffee garden bridge river old new first last big little").split()
+
+
+class Obj(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+class Corpus(object):
+	'''A made-up saved list and everything its posts link to.
+	Parameters:
+		count - number of posts.
+		mix - { kind: weight } with the kinds in DEFAULT_MIX.
+		image_kb, video_kb - average file sizes.
+		album_size - images in each album and gallery.
+	After construction 'posts' has the submissions, newest first, and
+	'resources' maps "host/path" to (content type, size or page text, seed).
+	'''
+
+	def __init__(self, count, mix=None, image_kb=300, video_kb=4096, album_size=4, seed=1):
+		self._rnd = random.Random(seed)
+		self._image = image_kb * 1024
+		self._video = video_kb * 1024
+		self._album_size = album_size
+		self.resources = {}
+		self.posts = []
+		mix = mix or DEFAULT_MIX
+		kinds = [ k for k in mix for _ in range(mix[k]) ]
+		for i in range(count):
+			kind = self._rnd.choice(kinds)
+			post_id = "b{:05x}".format(i)
+			url = getattr(self, '_make_' + kind)(post_id)
+			sub = Obj(url=url, id=post_id, name='t3_' + post_id, kind=kind,
+					  domain=normalize(urllib.parse.urlparse(url).hostname),
+					  title=" ".join(self._rnd.choice(WORDS) for _ in range(self._rnd.randint(2, 6))),
+					  author=Obj(name="user{}".format(self._rnd.randint(1, 50))),
+					  subreddit=Obj(display_name="sub{}".format(self._rnd.randint(1, 20))),
+					  created=1700000000 - i * 60, created_utc=1700000000 - i * 60)
+			if kind == 'gallery':
+				self._add_gallery(sub)
+			self.posts.append(sub)
+
+	def _size(self, mean):
+		return max(1024, int(self._rnd.uniform(0.5, 1.5) * mean))
+
+	def _media(self, url, content_type, mean):
+		key = resource_key(url)
+		self.resources[key] = (content_type, self._size(mean), self._rnd.random())
+		return url
+
+	def _page(self, url, text):
+		self.resources[resource_key(url)] = ('text/html; charset=utf-8', text, 0)
+		return url
+
+	def _make_image(self, post_id):
+		return self._media("https://i.redd.it/{}.jpg".format(post_id), 'image/jpeg', self._image)
+
+	def _make_video(self, post_id):
+		return self._media("https://i.imgur.com/{}.mp4".format(post_id), 'video/mp4', self._video)
+
+	def _make_redgifs(self, post_id):
+		video = self._media("https://thumbs2.redgifs.com/{}.mp4".format(post_id.title()), 'video/mp4', self._video)
+		ld = json.dumps({ '@type': 'VideoObject', 'video': { 'contentUrl': video } })
+		return self._page("https://www.redgifs.com/watch/{}".format(post_id),
+						  '<html><head><title>redgifs</title>'
+						  '<script type="application/ld+json">{}</script></head>'
+						  '<body>{}</body></html>'.format(ld, filler()))
+
+	def _make_gfycat(self, post_id):
+		target = self._make_redgifs(post_id + 'g')
+		return self._page("https://gfycat.com/{}".format(post_id),
+						  '<html><head><link rel="canonical" href="{}"></head><body>{}</body></html>'
+						  .format(target, filler()))
+
+	def _make_imgur(self, post_id):
+		self._media("https://i.imgur.com/{}.mp4".format(post_id), 'video/mp4', self._video)
+		return self._page("https://imgur.com/{}.gifv".format(post_id),
+						  '<html><body><video poster="//i.imgur.com/{0}h.jpg"></video>'
+						  '<div class="video-elements"><source src="//i.imgur.com/{0}.mp4" type="video/mp4">'
+						  '</div>{1}</body></html>'.format(post_id, filler()))
+
+	def _make_album(self, post_id):
+		members = [ ("{}.jpg".format(n), self._size(self._image), self._rnd.random())
+					for n in range(self._album_size) ]
+		self.resources[resource_key("http://s.imgur.com/a/{}/zip".format(post_id))] = \
+			('application/zip', members, 0)
+		return "https://imgur.com/a/{}".format(post_id)
+
+	def _add_gallery(self, sub):
+		media_ids = [ "{}m{}".format(sub.id, n) for n in range(self._album_size) ]
+		for media_id in media_ids:
+			self._media("https://i.redd.it/{}.jpg".format(media_id), 'image/jpeg', self._image)
+		sub.gallery_data = { 'items': [ { 'media_id': m } for m in media_ids ] }
+		sub.media_metadata = { m: { 'status': 'valid', 'm': 'image/jpg' } for m in media_ids }
+
+	def _make_gallery(self, post_id):
+		return "https://www.reddit.com/gallery/{}".format(post_id)
+
+
+def normalize(host):
+	return host[4:] if host.startswith('www.') else host
+
+
+def resource_key(url):
+	parts = urllib.parse.urlsplit(url)
+	return parts.hostname + parts.path
+
+
+def filler():
+	'''Page weight that comes before nothing useful, as on real pages.'''
+	return '<div class="x">' + ('<p>lorem ipsum dolor sit amet</p>' * 400) + '</div>'
+
+
+def make_body(content_type, spec, seed):
+	'''The bytes served for a resource.  Random so nothing compresses or dedups.'''
+	if content_type.startswith('text/'):
+		return spec.encode('utf-8')
+	if content_type == 'application/zip':
+		out = io.BytesIO()
+		with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as z:
+			for (name, size, member_seed) in spec:
+				z.writestr(name, make_body('image/jpeg', size, member_seed))
+		return out.getvalue()
+	magic = MAGIC.get(content_type, b'')
+	return magic + random.Random(seed).randbytes(spec - len(magic))
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_HEAD(self):
+		self._respond(False)
+
+	def do_GET(self):
+		self._respond(True)
+
+	def _respond(self, send_body):
+		server = self.server
+		if server.latency:
+			time.sleep(server.latency)
+		key = urllib.parse.urlsplit(self.path).path.lstrip('/')
+		body = server.body(key)
+		if body is None:
+			self._send(404, {}, b'not found', send_body)
+			return
+		(content_type, body) = body
+		etag = '"{:x}-{}"'.format(zlib.crc32(key.encode('utf-8')), len(body))
+		headers = { 'Content-Type': content_type, 'ETag': etag,
+					'Last-Modified': LAST_MODIFIED, 'Accept-Ranges': 'bytes' }
+		if self.headers.get('If-None-Match') == etag:
+			self._send(304, headers, b'', False)
+			return
+		status = 200
+		byte_range = self.headers.get('Range')
+		if byte_range and byte_range.startswith('bytes='):
+			(start, _, end) = byte_range[6:].partition('-')
+			start = int(start)
+			end = int(end) if end else len(body) - 1
+			if start >= len(body):
+				headers['Content-Range'] = 'bytes */{}'.format(len(body))
+				self._send(416, headers, b'', send_body)
+				return
+			end = min(end, len(body) - 1)
+			headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(body))
+			body = body[start:end + 1]
+			status = 206
+		self._send(status, headers, body, send_body)
+
+	def _send(self, status, headers, body, send_body):
+		self.send_response(status)
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if not send_body:
+			return
+		view = memoryview(body)
+		bandwidth = self.server.bandwidth
+		for pos in range(0, len(view), SEND_CHUNK):
+			chunk = view[pos:pos + SEND_CHUNK]
+			self.wfile.write(chunk)
+			if bandwidth:
+				time.sleep(len(chunk) / bandwidth)
+		with self.server.stats.get_lock():
+			self.server.stats[0] += 1
+			self.server.stats[1] += len(body)
+
+
+class _Server(ThreadingHTTPServer):
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, address, resources, latency, bandwidth, stats):
+		super().__init__(address, _Handler)
+		self.resources = resources
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.stats = stats
+		self._bodies = {}
+		self._lock = threading.Lock()
+
+	def body(self, key):
+		resource = self.resources.get(key)
+		if resource is None:
+			return None
+		with self._lock:
+			body = self._bodies.get(key)
+			if body is None:
+				body = make_body(*resource)
+				self._bodies[key] = body
+		return (resource[0], body)
+
+
+def _serve(resources, latency, bandwidth, stats, ready):
+	server = _Server(('127.0.0.1', 0), resources, latency, bandwidth, stats)
+	ready.send(server.server_address[1])
+	server.serve_forever()
+
+
+class LocalServer(object):
+	'''Serves a Corpus's resources over HTTP from a child process, so its
+	memory and CPU do not count against the downloader being measured.
+	Parameters:
+		latency - seconds before each response starts.
+		bandwidth - bytes per second for each response, 0 for no cap.
+	'''
+
+	def __init__(self, resources, latency=0.0, bandwidth=0):
+		self.stats = multiprocessing.Array('q', 2)	# requests, body bytes sent
+		(ours, theirs) = multiprocessing.Pipe()
+		self._process = multiprocessing.Process(target=_serve, daemon=True,
+												args=(resources, latency, bandwidth, self.stats, theirs))
+		self._process.start()
+		self.url = "http://127.0.0.1:{}".format(ours.recv())
+
+	@property
+	def requests(self):
+		return self.stats[0]
+
+	@property
+	def bytes_sent(self):
+		return self.stats[1]
+
+	def close(self):
+		self._process.terminate()
+		self._process.join()
+
+
+class RewriteAdapter(requests.adapters.HTTPAdapter):
+	'''Sends https://host/path to base/host/path.'''
+
+	def __init__(self, base, **kwargs):
+		super().__init__(**kwargs)
+		self.base = base
+
+	def send(self, request, **kwargs):
+		parts = urllib.parse.urlsplit(request.url)
+		request.url = "{}/{}{}".format(self.base, parts.hostname, parts.path) + \
+			("?" + parts.query if parts.query else "")
+		return super().send(request, **kwargs)
+
+
+def point_at(transport, server, pool_size=10):
+	'''Make every request through a script.Transport go to the local server.'''
+	adapter = RewriteAdapter(server.url, pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+	transport.session.adapters.clear()
+	transport.session.mount('http://', adapter)
+	transport.session.mount('https://', adapter)
+
+
+class FakeSubmission(Obj):
+
+	def unsave(self):
+		self._reddit.unsave(self.id)
+
+
+class FakeRedditor(object):
+	def __init__(self, reddit):
+		self._reddit = reddit
+
+	def saved(self, limit=None):
+		'''Yield the saved posts newest first, sleeping as each page of
+		100 is "fetched".'''
+		reddit = self._reddit
+		posts = [ p for p in reddit.saved_posts if p.id in reddit.saved_ids ]
+		for (n, post) in enumerate(posts):
+			if limit is not None and n >= limit:
+				return
+			if n % reddit.page_size == 0:
+				reddit.pages += 1
+				if reddit.page_latency:
+					time.sleep(reddit.page_latency)
+			yield post
+
+
+class FakeReddit(object):
+	'''Enough of praw.Reddit for save_posts.  Unsaved posts drop out of
+	the saved list the next time it is read.'''
+
+	def __init__(self, posts, username='bench', page_size=100, page_latency=0.0):
+		self.username = username
+		self.page_size = page_size
+		self.page_latency = page_latency
+		self.pages = 0
+		self.unsaved = 0
+		self.saved_posts = [ FakeSubmission(_reddit=self, **vars(p)) for p in posts ]
+		self.saved_ids = set(p.id for p in self.saved_posts)
+		self._by_id = { p.id: p for p in self.saved_posts }
+		self.user = Obj(me=lambda: self.username)
+
+	def redditor(self, name):
+		return FakeRedditor(self)
+
+	def submission(self, id):
+		return self._by_id[id]
+
+	def unsave(self, post_id):
+		self.saved_ids.discard(post_id)
+		self.unsaved += 1
@@ -5,8 +5,17 @@
 #   http://www.example.com/file2.txt
 import typing as t
 import requests
+import requests.adapters
 import pathlib
+import argparse
 import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 names: t.Dict[str,str] = {
     "ak": "anastasiyakvitko",
@@ -59,64 +68,230 @@ extensions: t.Dict[str,str] = {
     "j": "jpg",
 }
 
-def download_file(url, filename: pathlib.Path):
-    '''use requests to download a file'''
-    # create the file if it doesn't exist
-    filename.touch(exist_ok=True)
-    # open the file in binary mode
-    with open(filename, 'wb') as f:
-        # get request
-        r = requests.get(url)
-        # write to file
-        f.write(r.content)
+CHUNK_SIZE = 1024 * 1024
+# Files are written under this suffix and renamed when complete.
+PART_SUFFIX = ".part"
+# Progress of a manifest is kept beside it in a file with this suffix.
+JOURNAL_SUFFIX = ".journal.jsonl"
+TIMEOUT = (10, 60)
 
+# A download job: the url and the file to save it as.
+Job = t.Tuple[str, pathlib.Path]
 
-def simple(linkfilename: str, download_name_base: str, start_index: int):
-    """Download files from a list of urls."""
 
-    # Open the file with read only permit
+def make_session(pool_size: int = 10) -> requests.Session:
+    """A session that keeps up to pool_size connections per host open."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_file(url, filename: pathlib.Path,
+                  session: t.Optional[requests.Session] = None) -> t.Tuple[int, str]:
+    '''Stream a url to a file a chunk at a time.  The data goes to a .part
+    file which is renamed when complete, so a broken download never looks
+    finished.  Returns the size and sha256 hex digest.'''
+    part = filename.with_name(filename.name + PART_SUFFIX)
+    size = 0
+    hasher = hashlib.sha256()
+    with (session or requests).get(url, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        with open(part, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    os.replace(part, filename)
+    return (size, hasher.hexdigest())
+
+
+def file_digest(path: pathlib.Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class Journal(object):
+    """Rows of a manifest that have been downloaded, so a re-run can skip
+    them.  Each finished download is appended as one JSON line with its
+    url, path, size and sha256.  A row counts as done while its file is
+    still there with the recorded size (and, with verify, checksum);
+    anything else is fetched again."""
+
+    def __init__(self, path: str, verify: bool = False):
+        self.path = path
+        self.verify = verify
+        self._done: t.Dict[t.Tuple[str, str], t.Tuple[int, str]] = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._done[(entry['url'], entry['path'])] = (entry['size'], entry['sha256'])
+                    except (ValueError, KeyError):
+                        # A line cut short when a run was killed.
+                        continue
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def is_done(self, url: str, path: pathlib.Path) -> bool:
+        entry = self._done.get((url, str(path)))
+        if entry is None:
+            return False
+        (size, digest) = entry
+        try:
+            if os.path.getsize(path) != size:
+                return False
+            return not self.verify or file_digest(path) == digest
+        except OSError:
+            return False
+
+    def record(self, url: str, path: pathlib.Path, size: int, digest: str):
+        line = json.dumps({ 'url': url, 'path': str(path), 'size': size, 'sha256': digest, 'time': time.time() })
+        with self._lock:
+            self._done[(url, str(path))] = (size, digest)
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def link_jobs(linkfilename: str, download_name_base: str, start_index: int) -> t.Iterator[Job]:
+    """Jobs for a file with one url per line, named with a number."""
     with open(linkfilename, "r") as f:
-        links = f.readlines()
+        i: int = start_index
+        for link in f:
+            # Remove whitespace characters like `\n` at the end of each line
+            link = link.strip()
+            if not link:
+                continue
+            # create a file name with a number
+            yield (link, pathlib.Path(f"{download_name_base}_{i:04d}.mp4"))
+            i += 1
+
 
-    i: int = start_index
-    for link in links:
-        # Remove whitespace characters like `\n` at the end of each line
-        link = link.strip()
-        # create a file name with a number
-        download_file_name = f"{download_name_base}_{i:04d}.mp4"
-        i += 1
-        print ("Downloading file: %s" % download_file_name)
-        download_file(link, pathlib.Path(download_file_name))
+def manifest_jobs(linkfilename: str, namemap: t.Dict[str,str], target_dir: str) -> t.Iterator[Job]:
+    """Jobs for a CSV manifest, read a row at a time.
+    Columns: person,description,ext,url"""
+    with open(linkfilename, "r", newline='') as f:
+        for link in csv.DictReader(f):
+            person = namemap.get(link['person'], link['person'])
+            ext = link['ext'] or 'j'
+            extention = extensions.get(ext, ext)
+            description = link['description'].replace(' ', '_')
+            url = link['url'].strip()
+            download_file_name = f"{person}_{description}.{extention}"
+            yield (url, pathlib.Path(target_dir, download_file_name))
 
 
-def fancy(linkfilename: str, namemap: t.Dict[str,str], target_dir: str):
+def batch(jobs: t.Iterable[Job], workers: int = 4,
+          journal: t.Optional[Journal] = None) -> t.List[t.Tuple[Job, str]]:
+    """Download jobs with up to 'workers' at once over one pooled session.
+    Jobs are taken from the iterable only as workers free up, so a long
+    manifest is never read into memory.  Jobs the journal has as done are
+    skipped and new downloads are added to it.  A job for a file another
+    job is still writing waits for it.  Returns the jobs that failed with
+    their errors."""
+    workers = max(1, workers)
+    session = make_session(workers)
+    failed: t.List[t.Tuple[Job, str]] = []
+    pending: t.Dict[t.Any, Job] = {}
+    count = 0
+    skipped = 0
+
+    def collect():
+        nonlocal count
+        (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            (url, path) = pending.pop(future)
+            try:
+                (size, digest) = future.result()
+                count += 1
+                if journal is not None:
+                    journal.record(url, path, size, digest)
+                print ("Saved %s (%d bytes)" % (path, size))
+            except Exception as ex:
+                failed.append(((url, path), str(ex)))
+                print ("FAILED %s: %s" % (path, ex))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (url, path) in jobs:
+                if journal is not None and journal.is_done(url, path):
+                    skipped += 1
+                    continue
+                # Two rows for the same file would write the same .part at
+                # once, so the later one waits for the earlier to finish.
+                target = os.path.abspath(path)
+                while any(os.path.abspath(p) == target for (_, p) in pending.values()):
+                    collect()
+                print ("Downloading file: %s" % path)
+                pending[pool.submit(download_file, url, path, session)] = (url, path)
+                while len(pending) >= workers:
+                    collect()
+            while pending:
+                collect()
+    finally:
+        session.close()
+    if skipped:
+        print ("%d already downloaded" % skipped)
+    print ("%d downloaded, %d failed" % (count, len(failed)))
+    return failed
+
+
+def journaled(linkfilename: str, jobs: t.Iterable[Job], workers: int, use_journal: bool,
+              verify: bool = False):
+    """Run batch() with the manifest's journal, if wanted."""
+    if not use_journal:
+        return batch(jobs, workers)
+    journal = Journal(linkfilename + JOURNAL_SUFFIX, verify)
+    try:
+        return batch(jobs, workers, journal)
+    finally:
+        journal.close()
+
+
+def simple(linkfilename: str, download_name_base: str, start_index: int, workers: int = 1,
+           use_journal: bool = True, verify: bool = False):
     """Download files from a list of urls."""
+    return journaled(linkfilename, link_jobs(linkfilename, download_name_base, start_index),
+                     workers, use_journal, verify)
 
-    # Open the file with read only permit
-    # person,description,ext,url
-    links: list[dict[str,str]] = []
-    with open(linkfilename, "r", newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            links.append(row)
-
-    for link in links:
-        person = namemap.get(link['person'], link['person'])
-        if link['ext'] == '':
-            link['ext'] = 'j'
-        extention = extensions.get(link['ext'], link['ext'])
-
-        description = link['description'].replace(' ', '_')
-
-        # Remove whitespace characters like `\n` at the end of each line
-        url = link['url'].strip()
-        # create a file name with a number
-        download_file_name = f"{person}_{description}.{extention}"
-        download_path = pathlib.Path(target_dir, download_file_name)
-        
-        print ("Downloading file: %s" % download_file_name)
-        download_file(url, download_path)
-
-#main("video_link_list.txt", "softwparkling", 1)
-
-fancy("videolist.csv", names, "sv")
\ No newline at end of file
+
+def fancy(linkfilename: str, namemap: t.Dict[str,str], target_dir: str, workers: int = 1,
+          use_journal: bool = True, verify: bool = False):
+    """Download files from a list of urls."""
+    return journaled(linkfilename, manifest_jobs(linkfilename, namemap, target_dir),
+                     workers, use_journal, verify)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the files listed in a CSV manifest "
+                                     "(person,description,ext,url) or a file of links.")
+    parser.add_argument("manifest", nargs="?", default="videolist.csv")
+    parser.add_argument("target_dir", nargs="?", default="sv")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="downloads at the same time")
+    parser.add_argument("--links", metavar="BASE", help="manifest is one url per line; "
+                        "save as BASE_0001.mp4, ... in the current directory")
+    parser.add_argument("--start", type=int, default=1, help="first number used with --links")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="download every row, ignoring and not updating MANIFEST%s" % JOURNAL_SUFFIX)
+    parser.add_argument("--verify", action="store_true",
+                        help="check the sha256 of files the journal has as done, not just their size")
+    args = parser.parse_args()
+
+    use_journal = not args.no_journal
+    if args.links:
+        failed = simple(args.manifest, args.links, args.start, args.workers, use_journal, args.verify)
+    else:
+        failed = fancy(args.manifest, names, args.target_dir, args.workers, use_journal, args.verify)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Find the few elements a downloader needs in an HTML page without building
+a tree of the whole page.
+
+A downloader describes what it wants with a Target.  extract() feeds the
+page to a streaming parser as it arrives and stops parsing at the first
+match.  If nothing matches the whole page is handed to BeautifulSoup with
+the same description, in case the page is too broken for the simple parser.
+"""
+import codecs
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup as bs
+
+
+# Attributes holding a list of space separated values.  A string given for
+# one of these matches any of the values, as it does in BeautifulSoup.
+MULTI_VALUED = ('class', 'rel')
+
+CHUNK_SIZE = 16 * 1024
+
+
+class Target(object):
+	'''Description of the element(s) to find.
+	Parameters:
+		tag - tag name.
+		attrs - { name: wanted } where wanted is a string, a compiled regex
+				(searched for) or a function of the value.
+		text - also collect the text inside the element (e.g. a script).
+		within - a Target for an element the match must be inside.
+		many - find every match instead of only the first.
+	'''
+
+	def __init__(self, tag, attrs=None, text=False, within=None, many=False):
+		self.tag = tag
+		self.attrs = attrs or {}
+		self.text = text
+		self.within = within
+		self.many = many
+
+	def matches(self, tag, attrs):
+		if tag != self.tag:
+			return False
+		for (name, wanted) in self.attrs.items():
+			value = attrs.get(name)
+			if value is None:
+				return False
+			if isinstance(wanted, str):
+				if name in MULTI_VALUED:
+					if wanted not in value.split():
+						return False
+				elif value != wanted:
+					return False
+			elif hasattr(wanted, 'search'):
+				if not wanted.search(value):
+					return False
+			elif not wanted(value):
+				return False
+		return True
+
+
+class Element(object):
+	'''A found element.  Has the parts of the BeautifulSoup Tag interface
+	the downloaders use, so either can be returned.'''
+
+	def __init__(self, attrs, text=None):
+		self.attrs = attrs
+		self.text = text
+
+	def __getitem__(self, name):
+		return self.attrs[name]
+
+	def get(self, name, default=None):
+		return self.attrs.get(name, default)
+
+
+class _Found(Exception):
+	pass
+
+
+class _Finder(HTMLParser):
+
+	def __init__(self, target):
+		super().__init__(convert_charrefs=True)
+		self.target = target
+		self.found = []
+		self._within_depth = 0 if target.within is not None else None
+		self._open = None		# Matched element whose text is being collected
+
+	def handle_starttag(self, tag, attrs):
+		target = self.target
+		attrs = dict((k, v if v is not None else "") for (k, v) in attrs)
+		if self._within_depth is not None:
+			if self._within_depth == 0:
+				if target.within.matches(tag, attrs):
+					self._within_depth = 1
+				return
+			if tag == target.within.tag:
+				self._within_depth += 1
+		if target.matches(tag, attrs):
+			if target.text:
+				self._open = (attrs, [])
+			else:
+				self._add(Element(attrs))
+
+	def handle_endtag(self, tag):
+		if self._open is not None and tag == self.target.tag:
+			(attrs, text) = self._open
+			self._open = None
+			self._add(Element(attrs, "".join(text)))
+		if self._within_depth and tag == self.target.within.tag:
+			self._within_depth -= 1
+
+	def handle_data(self, data):
+		if self._open is not None:
+			self._open[1].append(data)
+
+	def _add(self, element):
+		self.found.append(element)
+		if not self.target.many:
+			raise _Found()
+
+
+def find_with_bs4(content, target):
+	'''The same search done by BeautifulSoup on the whole page.'''
+	soup = bs(content, features="html.parser")
+	scopes = [ soup ]
+	if target.within is not None:
+		# Every matching container is searched, as the streaming parser does.
+		scopes = soup.find_all(target.within.tag, target.within.attrs)
+	found = []
+	seen = set()
+	for scope in scopes:
+		if target.many:
+			# A container inside another has its matches found twice.
+			for element in scope.find_all(target.tag, target.attrs):
+				if id(element) not in seen:
+					seen.add(id(element))
+					found.append(element)
+		else:
+			element = scope.find(target.tag, target.attrs)
+			if element is not None:
+				return [ element ]
+	return found
+
+
+def extract(response, target):
+	'''
+	Find target in the body of a streamed requests response, parsing it
+	as it arrives.  Returns a list of Element (or BeautifulSoup Tag when
+	the fallback was needed).
+	'''
+	# Without a charset in Content-Type requests assumes ISO-8859-1, but
+	# pages that leave it out are nearly always UTF-8.
+	encoding = 'utf-8'
+	if 'charset' in response.headers.get('Content-Type', '').lower() and response.encoding:
+		encoding = response.encoding
+	try:
+		decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+	except LookupError:
+		decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+	finder = _Finder(target)
+	body = []
+	chunks = response.iter_content(CHUNK_SIZE)
+	try:
+		for chunk in chunks:
+			body.append(chunk)
+			finder.feed(decoder.decode(chunk))
+		finder.feed(decoder.decode(b"", final=True))
+		finder.close()
+	except _Found:
+		# Read the rest without parsing it so the connection can be reused.
+		for chunk in chunks:
+			pass
+		return finder.found
+	if finder.found:
+		return finder.found
+	return find_with_bs4(b"".join(body), target)
@@ -0,0 +1,171 @@
+"""
+Counters and timers for a run, so a slow run can be pinned on listing,
+page resolution, transfer, disk writes or unsaving.
+
+Everything is kept in memory under a lock and written out at the end as
+a JSON summary and/or a Prometheus textfile (for node_exporter's textfile
+collector).  start_live() also prints a status line and rewrites the
+textfile every few seconds while the run goes on.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+PROMETHEUS_PREFIX = 'reddit_saved_'
+
+
+def _labels_key(labels):
+	return tuple(sorted((k, str(v)) for (k, v) in labels.items() if v is not None))
+
+
+def _escape(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prom_labels(key):
+	if not key:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for (k, v) in key) + '}'
+
+
+class Metrics(object):
+	'''Named counters and timers, each split by labels such as domain.
+
+		metrics.add('bytes', 1024, domain='i.redd.it')
+		with metrics.timer('resolve', downloader='RedgifsDownloader'):
+			...
+
+	Safe to share between threads.
+	'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}		# name -> { labels: value }
+		self._timers = {}		# name -> { labels: [count, seconds, max] }
+		self._started = time.time()
+		self._live = None
+
+	def add(self, name, value=1, **labels):
+		key = _labels_key(labels)
+		with self._lock:
+			series = self._counters.setdefault(name, {})
+			series[key] = series.get(key, 0) + value
+
+	def observe(self, name, seconds, **labels):
+		'''Record one timed event of 'seconds'.'''
+		key = _labels_key(labels)
+		with self._lock:
+			series = self._timers.setdefault(name, {})
+			timing = series.get(key)
+			if timing is None:
+				series[key] = [1, seconds, seconds]
+			else:
+				timing[0] += 1
+				timing[1] += seconds
+				timing[2] = max(timing[2], seconds)
+
+	@contextlib.contextmanager
+	def timer(self, name, **labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, **labels)
+
+	def total(self, name):
+		'''A counter summed over all its labels.'''
+		with self._lock:
+			return sum(self._counters.get(name, {}).values())
+
+	def summary(self):
+		'''Everything recorded, as a dict that can be written as JSON.'''
+		with self._lock:
+			counters = { name: [ dict(key, value=value) for (key, value) in sorted(series.items()) ]
+						 for (name, series) in sorted(self._counters.items()) }
+			timers = { name: [ dict(key, count=t[0], seconds=round(t[1], 6), max=round(t[2], 6))
+							   for (key, t) in sorted(series.items()) ]
+					   for (name, series) in sorted(self._timers.items()) }
+		return { 'started': self._started, 'elapsed': time.time() - self._started,
+				 'counters': counters, 'timers': timers }
+
+	def write_json(self, path):
+		self._write(path, json.dumps(self.summary(), indent=2))
+
+	def prometheus(self):
+		'''The metrics in Prometheus text exposition format.'''
+		lines = []
+		with self._lock:
+			for (name, series) in sorted(self._counters.items()):
+				metric = PROMETHEUS_PREFIX + name + '_total'
+				lines.append('# TYPE {} counter'.format(metric))
+				for (key, value) in sorted(series.items()):
+					lines.append('{}{} {}'.format(metric, _prom_labels(key), value))
+			for (name, series) in sorted(self._timers.items()):
+				metric = PROMETHEUS_PREFIX + name + '_seconds'
+				lines.append('# TYPE {} summary'.format(metric))
+				for (key, (count, seconds, longest)) in sorted(series.items()):
+					lines.append('{}_sum{} {:.6f}'.format(metric, _prom_labels(key), seconds))
+					lines.append('{}_count{} {}'.format(metric, _prom_labels(key), count))
+				lines.append('# TYPE {}_max gauge'.format(metric))
+				for (key, (count, seconds, longest)) in sorted(series.items()):
+					lines.append('{}_max{} {:.6f}'.format(metric, _prom_labels(key), longest))
+		lines.append('# TYPE {}last_update_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX))
+		lines.append('{}last_update_timestamp_seconds {:.0f}'.format(PROMETHEUS_PREFIX, time.time()))
+		return '\n'.join(lines) + '\n'
+
+	def write_prometheus(self, path):
+		self._write(path, self.prometheus())
+
+	def _write(self, path, text):
+		# Written beside the target and renamed so readers never see half a file.
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			f.write(text)
+		os.replace(tmp_path, path)
+
+	def report(self, out=None):
+		'''Print where the time went, longest stage first, and bytes per domain.'''
+		out = out or sys.stdout
+		with self._lock:
+			stages = [ (name, sum(t[0] for t in series.values()), sum(t[1] for t in series.values()))
+					   for (name, series) in self._timers.items() ]
+			received = dict(self._counters.get('bytes', {}))
+		print ("Time by stage (summed over threads):", file=out)
+		for (name, count, seconds) in sorted(stages, key=lambda s: -s[2]):
+			print ("    {:<20} {:10.2f}s {:8d} times".format(name, seconds, count), file=out)
+		if received:
+			print ("Bytes by domain:", file=out)
+			for (key, value) in sorted(received.items(), key=lambda kv: -kv[1]):
+				print ("    {:<30} {:10.1f} MB".format(dict(key).get('domain', ''), value / 1e6), file=out)
+
+	def start_live(self, interval=10.0, textfile=None, out=None):
+		'''Every 'interval' seconds print a status line and rewrite 'textfile'
+		if given, until stop_live().'''
+		out = out or sys.stdout
+		stop = threading.Event()
+
+		def run():
+			last = (time.monotonic(), 0)
+			while not stop.wait(interval):
+				(now, received) = (time.monotonic(), self.total('bytes'))
+				print ("[metrics] {} posts, {} requests, {:.1f} MB, {:.2f} MB/s".format(
+					self.total('posts'), self.total('http_responses'), received / 1e6,
+					(received - last[1]) / 1e6 / max(now - last[0], 1e-9)), file=out)
+				last = (now, received)
+				if textfile:
+					self.write_prometheus(textfile)
+
+		thread = threading.Thread(target=run, name="metrics", daemon=True)
+		self._live = (stop, thread)
+		thread.start()
+
+	def stop_live(self):
+		if self._live is not None:
+			(stop, thread) = self._live
+			stop.set()
+			thread.join()
+			self._live = None
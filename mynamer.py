@@ -1,7 +1,12 @@
 import re
 import datetime
+import functools
 
 
+# Punctuation dropped from file names, and characters trimmed from the end.
+PUNCTUATION_RE = re.compile(r"[/\\[\]\"';,.@#$%^&*(){}|!\?]")
+TRAILING_RE = re.compile(r"[_~-]+$")
+
 
 class PersonName(object):
 	'''An person's name with variants for how that name may appear.'''
@@ -22,18 +27,80 @@ class PersonName(object):
 				return True
 
 
+class NameMatcher(object):
+	'''Finds the first of a list of PersonNames that appears in a string.
+
+	Gives the same answer as trying is_name() on each name in turn, but
+	the variants of all names are compiled into one regex shaped like a
+	trie, so a string is scanned once however many names there are.  The
+	regex only says where some variant starts; the trie is then walked
+	from there to find the earliest name in the list that matches.
+	'''
+
+	def __init__(self, names):
+		self._names = names
+		# Nested dicts keyed by character.  The None key holds the index of
+		# the first name with a variant ending at that node.
+		self._trie = {}
+		for (index, name) in enumerate(names):
+			for variant in name._variants:
+				node = self._trie
+				for c in variant:
+					node = node.setdefault(c, {})
+				if None not in node:
+					node[None] = index
+		self._re = None
+		if names:
+			self._re = re.compile("(?={})".format(self._pattern(self._trie)))
+
+	@classmethod
+	def _pattern(cls, node):
+		alternatives = [ re.escape(c) + cls._pattern(child)
+						 for (c, child) in sorted((k, v) for (k, v) in node.items() if k is not None) ]
+		if not alternatives:
+			return ""
+		pattern = alternatives[0] if len(alternatives) == 1 else "(?:{})".format("|".join(alternatives))
+		if None in node:
+			pattern = "(?:{})?".format(pattern)
+		return pattern
+
+	def first_index(self, s):
+		'''Index of the first name found in s, or None.'''
+		if self._re is None:
+			return None
+		ls = s.lower()
+		best = self._trie.get(None)
+		for m in self._re.finditer(ls):
+			node = self._trie
+			for c in ls[m.start():]:
+				node = node.get(c)
+				if node is None:
+					break
+				index = node.get(None)
+				if index is not None and (best is None or index < best):
+					best = index
+			if best == 0:
+				break
+		return best
+
+
 class FileNamer(object):
 	def __init__(self, yamlConfig):
 		self._following = yamlConfig['following']
 		self._subusingnames = yamlConfig['subusingnames']
 		self._names = [ PersonName(x) for x in yamlConfig['names'] ]
+		self._matcher = NameMatcher(self._names)
+		# The same authors and subreddits come up again and again.
+		self._cached_index = functools.lru_cache(maxsize=4096)(self._matcher.first_index)
 
 
 	def _recognize_person_name(self, title, author, sub_name):
-		for name in self._names:
-			if name.is_name(title) or name.is_name(author) or name.is_name(sub_name):
-				return name.name
-		return None
+		found = [ i for i in (self._matcher.first_index(title),
+							  self._cached_index(author),
+							  self._cached_index(sub_name)) if i is not None ]
+		if not found:
+			return None
+		return self._names[min(found)].name
 
 	def _posting_time(self, submission):
 		try:
@@ -58,11 +125,11 @@ class FileNamer(object):
 			# Replace a common result of removing space
 			ann = ann.replace("_-_", "-")
 			# Remove the fussy punctuation
-			ann = re.sub("[/\\\[\]\"';,.@#$%^&*(){}|!\?]", "", ann)
+			ann = PUNCTUATION_RE.sub("", ann)
 			# Replace double punctuation
 			#for p in "-_"
 			# Remove some charactes from end of string.
-			ann = re.sub("[_~-]+$", "", ann)
+			ann = TRAILING_RE.sub("", ann)
 			return ann
 
 		# Get author.  There may not be one.
@@ -0,0 +1,91 @@
+"""
+Request pacing.
+"""
+import threading
+import time
+import urllib.parse
+
+
+def normalize_host(host):
+	'''Lower case a host name and drop any leading "www.".'''
+	host = (host or "").lower()
+	if host.startswith("www."):
+		host = host[4:]
+	return host
+
+
+def match_domain(table, host):
+	'''Find the entry for a host in a table keyed by normalized domain,
+	trying the host and then each parent domain.  Returns (key, value)
+	or (host, None) if nothing matches.'''
+	host = normalize_host(host)
+	parts = host.split('.')
+	for i in range(len(parts) - 1):
+		candidate = '.'.join(parts[i:])
+		if candidate in table:
+			return (candidate, table[candidate])
+	return (host, None)
+
+
+class TokenBucket(object):
+	'''Allows 'rate' operations per second on average with bursts of up
+	to 'burst' operations.  acquire() blocks until a token is free.
+	A rate of 0 means no limit.  Safe to share between threads.
+	'''
+
+	def __init__(self, rate, burst=1):
+		self.rate = float(rate)
+		self.burst = max(1.0, float(burst))
+		self._tokens = self.burst
+		self._stamp = time.monotonic()
+		self._lock = threading.Lock()
+
+	def _refill(self, now):
+		self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+		self._stamp = now
+
+	def acquire(self, tokens=1):
+		'''Take 'tokens', sleeping until they are available.  Returns the
+		time spent waiting.'''
+		if self.rate <= 0:
+			return 0.0
+		waited = 0.0
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._refill(now)
+				if self._tokens >= tokens:
+					self._tokens -= tokens
+					return waited
+				wait = (tokens - self._tokens) / self.rate
+			time.sleep(wait)
+			waited += wait
+
+
+class RateLimiter(object):
+	'''A token bucket per domain.
+
+	'limits' maps a domain to { 'rate': requests per second, 'burst': n }.
+	A domain's limit also covers its sub-domains, and hosts with no entry
+	share nothing and get 'default' each.  A rate of 0 is unlimited.
+	'''
+
+	def __init__(self, limits=None, default=None):
+		self._limits = { normalize_host(k): v for (k, v) in (limits or {}).items() }
+		self._default = default or { 'rate': 0 }
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def bucket_for(self, host):
+		(key, limit) = match_domain(self._limits, host)
+		with self._lock:
+			bucket = self._buckets.get(key)
+			if bucket is None:
+				limit = limit or self._default
+				bucket = TokenBucket(limit.get('rate', 0), limit.get('burst', 1))
+				self._buckets[key] = bucket
+		return bucket
+
+	def acquire(self, url):
+		'''Wait until a request to the host of 'url' is allowed.'''
+		return self.bucket_for(urllib.parse.urlparse(url).hostname).acquire()
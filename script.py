@@ -3,26 +3,33 @@ Python script to download saved images from reddit
 """
 import typing as t
 import requests
+import requests.adapters
+import urllib3
 import os
 import sys
 import re
 import traceback
-import shutil
+import tempfile
 import importlib.util
 import urllib.parse
-from glob import glob
-from bs4 import BeautifulSoup as bs
+from glob import glob, escape as glob_escape
 from zipfile import ZipFile
 #TODO:  remove from PIL import Image
 import praw
-try:
-	from io import BytesIO
-except ImportError:
-	from StringIO import BytesIO
 import time
 import yaml
 import json
 import html
+import hashlib
+import threading
+import queue
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import statestore
+import ratelimit
+import htmlextract
+from ratelimit import normalize_host, match_domain
+from metrics import Metrics
 
 
 
@@ -36,6 +43,53 @@ IMAGE_FORMATS = ['bmp', 'dib', 'eps', 'ps', 'gif', 'im', 'jpg', 'jpe', 'jpeg',
 
 VIDEO_FORMATS = ['mp4']
 
+# Signatures at the start of media files: (offset, bytes, extension).
+MAGIC_NUMBERS = [
+	(0, b'\xff\xd8\xff', 'jpg'),
+	(0, b'\x89PNG\r\n\x1a\n', 'png'),
+	(0, b'GIF87a', 'gif'),
+	(0, b'GIF89a', 'gif'),
+	(8, b'WEBP', 'webp'),
+	(4, b'ftyp', 'mp4'),
+	(0, b'\x1aE\xdf\xa3', 'webm'),
+	(0, b'II*\x00', 'tif'),
+	(0, b'MM\x00*', 'tif'),
+	(0, b'BM', 'bmp'),
+	(0, b'PK\x03\x04', 'zip'),
+]
+
+MEDIA_EXTENSIONS = set(IMAGE_FORMATS + VIDEO_FORMATS + [ ext for (_, _, ext) in MAGIC_NUMBERS ])
+
+# Responses of these types are pages, not media, and are not read at all.
+PAGE_TYPES = ('text/html', 'application/xhtml+xml', 'application/json')
+
+COPY_CHUNK_SIZE = 64 * 1024
+# Media bodies are read into and written from one buffer of this size.
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Bytes of the start of a body given to sniff_media().
+SNIFF_SIZE = 512
+# Downloads are written here and renamed when complete.
+PART_SUFFIX = '.part'
+# The URL and validators a .part file came from, and how much of it has
+# been written, are kept beside it in a file named for it with this added.
+PART_INFO_SUFFIX = '.json'
+# How often, in bytes written, that record is brought up to date.
+PART_PROGRESS_INTERVAL = 8 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+# Album zips bigger than this are spooled to disk instead of memory.
+ALBUM_SPOOL_SIZE = 8 * 1024 * 1024
+# Images of one album or gallery fetched at the same time.
+ALBUM_WORKERS = 4
+# Versions of one video asked about (HEAD) at the same time.
+RENDITION_PROBES = 4
+# Posts per worker that may wait for a busy host while later posts for
+# other hosts are started.
+HELD_POSTS_PER_WORKER = 4
+# Newest saved posts remembered for the next run to stop listing at.
+CURSOR_DEPTH = 20
+# A failed post keeps the cursor from moving past it for this many attempts.
+CURSOR_RETRIES = 3
+
 user_agent_version = 1.0
 
 def get_user_agent() -> str:
@@ -46,6 +100,80 @@ def get_user_agent() -> str:
 def make_headers(url: str) -> t.Dict[str,str]:
 	return { 'User-Agent': get_user_agent() }
 
+def url_domain(url):
+	return normalize_host(urllib.parse.urlparse(url).hostname)
+
+
+class Transport(object):
+	'''HTTP access shared by all downloaders.
+
+	Every request goes through one requests.Session so connections are
+	kept alive and reused instead of paying for a new TCP and TLS
+	handshake each time.  Each request gets the make_headers() headers
+	and a default timeout.  The pool size is a hard cap: a request that
+	finds every connection to its host in use waits for one to be put
+	back, so album, gallery and segment fetches share it with the posts.
+	Parameters:
+		pool_size - connections open at once per host, see pool_size_for().
+		host_pool_sizes - pool size for particular hosts, e.g. { 'i.redd.it': 16 }.
+		timeout - (connect, read) timeout in seconds.
+		limiter - ratelimit.RateLimiter every request waits on.
+		metrics - Metrics that get the time, status and errors of each request.
+	'''
+
+	def __init__(self, pool_size=10, host_pool_sizes=None, timeout=(10, 60), limiter=None, metrics=None):
+		self.timeout = timeout
+		self.limiter = limiter
+		self.metrics = metrics or Metrics()
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		for (host, size) in (host_pool_sizes or {}).items():
+			adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=True)
+			self.session.mount('http://{}/'.format(host), adapter)
+			self.session.mount('https://{}/'.format(host), adapter)
+
+	def request(self, method, url, headers=None, **kwargs):
+		all_headers = make_headers(url)
+		if headers:
+			all_headers.update(headers)
+		kwargs.setdefault('timeout', self.timeout)
+		domain = url_domain(url)
+		if self.limiter is not None:
+			waited = self.limiter.acquire(url)
+			if waited:
+				self.metrics.observe('rate_limit_wait', waited, domain=domain)
+		start = time.perf_counter()
+		try:
+			rv = self.session.request(method, url, headers=all_headers, **kwargs)
+		except requests.exceptions.RequestException as ex:
+			self.metrics.add('http_errors', domain=domain, error=type(ex).__name__)
+			raise
+		# For a streamed request this is the time to the response headers.
+		self.metrics.observe('http_request', time.perf_counter() - start, domain=domain)
+		self.metrics.add('http_responses', domain=domain, method=method, status=rv.status_code)
+		return rv
+
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+
+	def head(self, url, **kwargs):
+		kwargs.setdefault('allow_redirects', True)
+		return self.request('HEAD', url, **kwargs)
+
+	def close(self):
+		self.session.close()
+
+def pool_size_for(workers, segments=1):
+	"""
+	Connections one host may need when 'workers' posts are downloaded at
+	once and each of them fetches ALBUM_WORKERS album or gallery images,
+	probes RENDITION_PROBES versions of a video, or fetches 'segments'
+	ranges of one, at the same time.
+	"""
+	return max(10, workers * max(ALBUM_WORKERS, RENDITION_PROBES, segments))
+
 def is_image_link(url):
 	"""
 	Takes a praw.Submission object and returns a boolean
@@ -70,6 +198,176 @@ class DownloaderException(Exception):
 	pass
 
 
+class NotModified(Exception):
+	'''The server says the copy saved before is still current.'''
+	pass
+
+
+class DownloadInterrupted(Exception):
+	'''The connection ended before the whole body had been received.'''
+	pass
+
+
+class NotMedia(DownloaderException):
+	'''The server sent something other than media, such as an error or login page.'''
+	pass
+
+
+def media_type(content_type):
+	return (content_type or '').split(';')[0].strip().lower()
+
+
+def sniff_media(content_type, head):
+	"""
+	Decide from the Content-Type and the first bytes of a response whether
+	it is media.  Returns the extension the bytes show ('jpg', 'mp4', ...)
+	or '' if they are not recognised but could still be media.  Raises
+	NotMedia if it is a page or other text.
+	"""
+	for (offset, magic, ext) in MAGIC_NUMBERS:
+		if head[offset:offset + len(magic)] == magic:
+			return ext
+	ctype = media_type(content_type)
+	if ctype == 'image/svg+xml':
+		return 'svg'
+	if ctype.startswith('text/') or ctype in PAGE_TYPES:
+		raise NotMedia("Got {} instead of media".format(ctype))
+	if head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] in (b'<', b'{'):
+		raise NotMedia("Got a page instead of media")
+	return ''
+
+
+def read_head(raw, buffer):
+	"""
+	Read the first SNIFF_SIZE bytes of a body, or all of it if it is
+	shorter, into the start of buffer for sniff_media().  Returns how many
+	bytes were read.
+	"""
+	filled = 0
+	while filled < SNIFF_SIZE:
+		count = raw.readinto(buffer[filled:SNIFF_SIZE])
+		if not count:
+			break
+		filled += count
+	return filled
+
+
+def is_partial(name):
+	'''Whether a file name is an unfinished download or its record.'''
+	return name.endswith(PART_SUFFIX) or name.endswith(PART_SUFFIX + PART_INFO_SUFFIX)
+
+
+def if_range(info):
+	"""
+	The If-Range value for resuming a download recorded as 'info': its
+	ETag, unless that is weak, or else its Last-Modified.  None if there is
+	nothing the server could check it against.
+	"""
+	etag = info.get('etag')
+	if etag and not etag.startswith('W/'):
+		return etag
+	return info.get('last_modified')
+
+
+def content_range_start(value):
+	'''The first byte of a 'bytes start-end/total' Content-Range, or None.'''
+	m = re.match(r'\s*bytes\s+(\d+)-', value or '')
+	return int(m.group(1)) if m else None
+
+
+# Errors after which a download is worth resuming.
+RETRYABLE_ERRORS = (DownloadInterrupted, requests.exceptions.RequestException,
+					urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+
+
+def preallocate_file(f, length):
+	"""
+	Reserve 'length' bytes of f from its current position, so a file that
+	is written a piece at a time (often several at once) is laid out in one
+	run on disk.  This makes the file that long.  Returns False if the
+	platform or file system cannot do it.
+	"""
+	if length <= 0 or not hasattr(os, 'posix_fallocate'):
+		return False
+	f.flush()
+	try:
+		os.posix_fallocate(f.fileno(), f.tell(), length)
+	except OSError:
+		return False
+	return True
+
+
+def copy_stream(raw, f, buffer, hasher=None, filled=0, limit=None, progress=None):
+	"""
+	Copy raw (anything with readinto) to f through 'buffer', a memoryview
+	used for every read, so a body goes to disk in a few large writes and
+	no new bytes objects.  The first 'filled' bytes of the buffer were
+	already read and are written first.  Stops after 'limit' bytes if
+	given.  The data is added to 'hasher' on the way, and progress(bytes
+	written so far) called after each write.
+	Returns (bytes written, seconds spent writing).
+	"""
+	size = 0
+	write_time = 0.0
+	count = filled
+	while True:
+		if not count:
+			want = len(buffer) if limit is None else min(len(buffer), limit - size)
+			count = raw.readinto(buffer[:want]) if want > 0 else 0
+			if not count:
+				return (size, write_time)
+		chunk = buffer[:count]
+		if hasher is not None:
+			hasher.update(chunk)
+		start = time.perf_counter()
+		f.write(chunk)
+		write_time += time.perf_counter() - start
+		size += count
+		count = 0
+		if progress is not None:
+			progress(size)
+
+
+
+class HostLimiter(object):
+	'''Caps how many downloads may run at once against each host.
+
+	Limits are looked up by the host and then each parent domain, so a
+	limit for 'imgur.com' also covers 'i.imgur.com'.  Hosts with no
+	configured limit get 'default' (0 means no per-host cap).
+
+	save_posts takes slots with try_acquire() before handing a post to a
+	worker, so a post for a busy host waits in the main loop rather than
+	in a worker that could be fetching from another host.
+	'''
+
+	def __init__(self, limits=None, default=0):
+		self._limits = { normalize_host(k): v for (k, v) in (limits or {}).items() }
+		self._default = default
+		self._running = {}
+		self._lock = threading.Lock()
+
+	def _limit(self, host):
+		(key, limit) = match_domain(self._limits, host)
+		return (key, self._default if limit is None else limit)
+
+	def try_acquire(self, host):
+		'''Take a slot for host if one is free.  Returns False if it is busy.'''
+		(key, limit) = self._limit(host)
+		with self._lock:
+			if limit and self._running.get(key, 0) >= limit:
+				return False
+			self._running[key] = self._running.get(key, 0) + 1
+		return True
+
+	def release(self, host):
+		(key, _) = self._limit(host)
+		with self._lock:
+			self._running[key] -= 1
+			if not self._running[key]:
+				del self._running[key]
+
+
 
 class FileNamer(object):
 
@@ -110,6 +408,72 @@ class FileNamer(object):
 		return file_name
 
 
+class NameAllocator(object):
+	'''Hands out unique file names, adding _01, _02, ... to names in use.
+
+	Each directory is listed once, the first time a name in it is wanted,
+	and the names found are kept with the highest number used for each
+	name.  After that a name is found without touching the disk, and is
+	reserved as soon as it is handed out, so workers running at the same
+	time can never be given the same name.  .part files do not count,
+	which lets an interrupted download get its old name back.
+	'''
+
+	SUFFIX_RE = re.compile(r'^(.*)_(\d{2,})$')
+
+	def __init__(self):
+		self._dirs = {}
+		self._lock = threading.Lock()
+
+	def _index(self, directory):
+		index = self._dirs.get(directory)
+		if index is None:
+			taken = set()
+			highest = {}
+			try:
+				names = os.listdir(directory)
+			except FileNotFoundError:
+				names = []
+			for name in names:
+				if is_partial(name):
+					continue
+				taken.add(name)
+				(stem, ext) = os.path.splitext(name)
+				m = self.SUFFIX_RE.match(stem)
+				if m:
+					key = (m.group(1), ext)
+					highest[key] = max(highest.get(key, 0), int(m.group(2)))
+			index = (taken, highest)
+			self._dirs[directory] = index
+		return index
+
+	def scan(self, directory):
+		'''List a directory now rather than on first use.'''
+		with self._lock:
+			self._index(os.path.abspath(directory))
+
+	def allocate(self, path):
+		(directory, name) = os.path.split(path)
+		(stem, ext) = os.path.splitext(name)
+		with self._lock:
+			(taken, highest) = self._index(os.path.abspath(directory))
+			if name in taken:
+				num = highest.get((stem, ext), 0)
+				while name in taken:
+					num += 1
+					name = "{}_{:02d}{}".format(stem, num, ext)
+				highest[(stem, ext)] = num
+			taken.add(name)
+		return os.path.join(directory, name)
+
+	def release(self, path):
+		'''Give back a name that was not used after all.'''
+		(directory, name) = os.path.split(path)
+		with self._lock:
+			(taken, highest) = self._index(os.path.abspath(directory))
+			taken.discard(name)
+
+
 class SavedPost(object):
 	'''A post saved by the user which we will try to download.
 	'''
@@ -128,12 +492,16 @@ class SavedPost(object):
 		self.saved_path = ""
 		self.status_code = self.STATUS_PENDING
 		self.error_message = ""
+		self.duplicates = []		# (path, original path) for content already saved
 
 
 	def set_saved(self, saved_path):
 		self.status_code = self.STATUS_SAVED
 		self.saved_path = saved_path
 
+	def add_duplicate(self, path, original_path):
+		self.duplicates.append((path, original_path))
+
 	def set_exception(self, message):
 		self.status_code = self.STATUS_EXCEPTION
 		self.error_message = message
@@ -153,18 +521,193 @@ class SavedPost(object):
 
 
 
+class Rendition(object):
+	'''One of the versions of a video a page offers.  size is filled in
+	by Downloader._choose_rendition.'''
+
+	def __init__(self, url, width=None, height=None):
+		self.url = url
+		self.width = int_or_none(width)
+		self.height = int_or_none(height)
+		self.size = None
+
+	def quality(self):
+		return (self.height or 0, self.width or 0, self.size or 0)
+
+
+def int_or_none(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+
+
+class DownloaderRegistry(object):
+	"""
+	Which Downloader handles a post.
+
+	Downloader classes register the URL extensions, domains and URL
+	patterns they handle.  A domain covers its sub-domains.  Finding the
+	downloader is a dict lookup on the extension, then on the host and
+	each parent domain, then a check of the few patterns registered for
+	that domain in the order they were registered.  Downloaders marked
+	experimental are only used when asked for.
+
+	More downloaders can come from modules named in the config, loaded the
+	way namer_module is.  Such a module has a register(registry) function;
+	registry.Downloader is the base class to derive from:
+
+		def register(registry):
+			@registry.register(domains=['vidble.com'])
+			class VidbleDownloader(registry.Downloader):
+				def download(self):
+					...
+
+	A module given with the domains it handles is only loaded when the
+	first post for one of them turns up.
+	"""
+
+	def __init__(self, base):
+		self.Downloader = base
+		self._extensions = {}	# extension -> class
+		self._domains = {}		# domain -> [ (compiled pattern or None, class, experimental) ]
+		self._modules = {}		# domain -> path of a module not loaded yet
+		self._lock = threading.RLock()
+
+	def register(self, domains=(), pattern=None, extensions=(), experimental=False):
+		'''Class decorator.  'pattern' is a regex searched for in the URL;
+		entries with one are tried before the domain's catch-all.'''
+		regex = re.compile(pattern) if pattern else None
+
+		def add(cls):
+			with self._lock:
+				for ext in extensions:
+					self._extensions[ext] = cls
+				for domain in domains:
+					entries = self._domains.setdefault(normalize_host(domain), [])
+					entries.append((regex, cls, experimental))
+					entries.sort(key=lambda e: e[0] is None)
+			return cls
+		return add
+
+	def add_module(self, path, domains=None):
+		'''Load the downloaders in the module at 'path' now, or only once
+		a post for one of 'domains' needs them.'''
+		if not domains:
+			self._load(path)
+			return
+		with self._lock:
+			for domain in domains:
+				self._modules[normalize_host(domain)] = path
+
+	def _load(self, path):
+		name = "downloaders_" + os.path.splitext(os.path.basename(path))[0]
+		spec = importlib.util.spec_from_file_location(name, path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		module.register(self)
+
+	def _load_for(self, host):
+		# Loading happens under the lock so no other worker can look for
+		# these domains before the module has registered its classes.
+		with self._lock:
+			(key, path) = match_domain(self._modules, host)
+			if path is None:
+				return
+			for domain in [ d for (d, p) in self._modules.items() if p == path ]:
+				del self._modules[domain]
+			print ("Loading downloaders from {}".format(path))
+			self._load(path)
+
+	def find(self, url, domain=None, is_expirmental=False):
+		'''The Downloader class for a URL, or None.'''
+		cls = self._extensions.get(urllib.parse.urlparse(url).path.split('.')[-1])
+		if cls is not None:
+			return cls
+		host = domain or urllib.parse.urlparse(url).hostname
+		if self._modules:
+			self._load_for(host)
+		(key, entries) = match_domain(self._domains, host)
+		for (regex, cls, experimental) in entries or ():
+			if experimental and not is_expirmental:
+				continue
+			if regex is None or regex.search(url):
+				return cls
+		return None
+
+
+
+class DownloadContext(object):
+	'''Everything the downloaders of one run share, handed to each one.
+
+	Parameters:
+		transport - Transport used for all HTTP requests.
+		metrics - Metrics to record timings and counts in (default: the
+				transport's).
+		state - optional StateStore.  Posts it records as saved are skipped,
+				every attempt is recorded in it, and it keeps the file,
+				resolve and duplicate indexes.
+		dedup - 'link' to hard link content that was saved before, 'drop'
+				to not keep the new copy at all, or 'off'.  Needs 'state'.
+		segments - byte ranges fetched at once for videos bigger than
+				segment_threshold_mb, if the server accepts ranges.  1 turns
+				this off.
+		resolve_ttl_days, resolve_max_entries - how long and how many page
+				to media URL answers are kept in 'state'.
+		rendition_policy - which version of a video to take when a page
+				offers several: 'best', 'smallest', 'max_size' (best under
+				rendition_max_mb) or 'max_resolution' (best no taller than
+				rendition_max_height).
+		write_buffer_kb - size of the buffer each download is copied to
+				disk through.
+		preallocate - reserve the whole file on disk before writing it when
+				the server gives its size.
+	'''
+
+	def __init__(self, transport=None, metrics=None, state=None, dedup='link',
+				 segments=4, segment_threshold_mb=32, resolve_ttl_days=7, resolve_max_entries=50000,
+				 rendition_policy='best', rendition_max_mb=0, rendition_max_height=0,
+				 write_buffer_kb=WRITE_BUFFER_SIZE // 1024, preallocate=True):
+		self.transport = transport or Transport(metrics=metrics)
+		self.metrics = metrics or self.transport.metrics
+		self.allocator = NameAllocator()
+		self.state = state
+		self.file_index = state		# validators of each URL saved
+		self.resolve_cache = state		# which media a page leads to
+		self.hash_index = state if dedup != 'off' else None		# content saved before
+		self.dedup = dedup
+		self.segment_count = segments
+		self.segment_threshold = int(segment_threshold_mb * 1024 * 1024)
+		self.resolve_ttl = resolve_ttl_days * 24 * 3600
+		self.resolve_max_entries = resolve_max_entries
+		self.rendition_policy = rendition_policy
+		self.rendition_max_mb = rendition_max_mb
+		self.rendition_max_height = rendition_max_height
+		self.write_buffer_size = int(write_buffer_kb * 1024)
+		self.preallocate = preallocate
+
 
 
 class Downloader(object):
 	"""
 	Downloader class.
 	Define here all methods to download images from different hosts or
-	even direct link to image
+	even direct link to image.  Each is made for one post, with the
+	DownloadContext of the run.
 	"""
 	# global ERRORS
 
-	def __init__(self, saved_post):
+	# Domain the media of the posts this handles is fetched from, when it
+	# is not the post's own.  Host caps are counted against it.
+	media_domain = None
+
+	# Copy buffers, one per thread, kept from one download to the next.
+	_buffers = threading.local()
+
+	def __init__(self, saved_post, context):
 		self.saved_post = saved_post
+		self.context = context
 		self.submission = saved_post.submission
 		self.album_path = os.path.join(self.saved_post.save_dir, 'albums')
 		print("    Downloading {} - {} ({})".format(self.submission.subreddit.display_name, self.submission.title, self.submission.url))
@@ -180,12 +723,7 @@ class Downloader(object):
 		return os.path.isfile(path) if is_file else len(glob(path + '*')) >= 1
 
 	def _mk_unique_name(self, path):
-		num = 1
-		(p,e) = os.path.splitext(path)
-		while os.path.exists(path):
-			path = "{}_{:02d}{}".format(p, num, e)
-			num += 1
-		return path
+		return self.context.allocator.allocate(path)
 
 
 	# This version uses Pillow (PIL) image library to
@@ -219,22 +757,539 @@ class Downloader(object):
 			(p, extension) = os.path.splitext(urlParts.path)
 
 		file_path = self._mk_unique_name(file_path_base + extension)
-		
+		return self._download_to_path(url, file_path)
+
+	def _download_to_path(self, url, file_path):
+		'''Download url to a name already given out by _mk_unique_name.'''
+		part_path = file_path + PART_SUFFIX
+		extension = os.path.splitext(file_path)[1]
+
+		resuming = self._resumable_part(url, part_path) is not None
+		# If this URL was saved before, ask the server whether it changed
+		# rather than fetching the body again.
+		saved = None if resuming else self._saved_copy(url)
+		conditions = {}
+		if saved is not None:
+			(saved_path, saved_size, conditions) = saved
+			if not conditions and self._same_size(url, saved_size):
+				return self._unchanged(file_path, saved_path)
 
-		# Initiate the request.  stream=True allows streaming reading
-		# (and use of copyfileobj)
-		rv = requests.get(url, headers=make_headers(url), stream=True)
-		if rv.status_code != 200:
-			self.saved_post.set_error("Request to {} returned code {}".format(url, rv.status_code))
-			rv.close()
-			print (f"   HTTP get returned {rv.status_code}")
-			raise DownloaderException()
-			
 		print ("    Saved to {}".format(file_path))
-		with open(file_path, 'wb') as f:
-			rv.raw.decode_content = True
-			shutil.copyfileobj(rv.raw, f)   
-		rv.close()
+		try:
+			head = None
+			kind = None
+			if extension.lstrip('.').lower() in VIDEO_FORMATS and not resuming:
+				head = self._segment_head(url, conditions)
+			if head is not None:
+				(digest, size, kind) = self._fetch_segmented(url, part_path, int(head['Content-Length']),
+													   if_range({ 'etag': head.get('ETag'),
+																  'last_modified': head.get('Last-Modified') }))
+				validators = head
+			else:
+				(digest, size, validators, kind) = self._fetch_to_part(url, part_path, conditions)
+		except NotModified:
+			return self._unchanged(file_path, saved_path)
+		if kind and extension.lstrip('.').lower() not in MEDIA_EXTENSIONS:
+			# The URL did not say what this is.  Name it for what it turned out to be.
+			named = self._mk_unique_name(file_path[:len(file_path) - len(extension)] + '.' + kind)
+			self.context.allocator.release(file_path)
+			file_path = named
+		# Only a complete file gets the real name.
+		os.replace(part_path, file_path)
+		self._drop_part(part_path)
+		file_path = self._dedup(file_path, digest, size)
+		if self.context.file_index is not None:
+			self.context.file_index.put_file(url, file_path, size, validators.get('ETag'), validators.get('Last-Modified'))
+		return file_path
+
+	def _saved_copy(self, url):
+		"""
+		Find a complete copy of url saved by an earlier download.
+		Returns (path, size, conditional request headers) or None.
+		"""
+		if self.context.file_index is None:
+			return None
+		row = self.context.file_index.get_file(url)
+		if row is None or not self._check_if_image_exists(row['path']) \
+				or os.path.getsize(row['path']) != row['size']:
+			return None
+		conditions = {}
+		if row['etag']:
+			conditions['If-None-Match'] = row['etag']
+		if row['last_modified']:
+			conditions['If-Modified-Since'] = row['last_modified']
+		return (row['path'], row['size'], conditions)
+
+	def _same_size(self, url, size):
+		'''With no validators to go on, HEAD the URL and compare sizes.'''
+		try:
+			rv = self.context.transport.head(url, headers={ 'Accept-Encoding': 'identity' })
+			rv.close()
+		except requests.exceptions.RequestException:
+			return False
+		return rv.status_code == 200 and rv.headers.get('Content-Length') == str(size)
+
+	def _unchanged(self, file_path, saved_path):
+		self.context.allocator.release(file_path)
+		self.context.metrics.add('unchanged')
+		print ("    Unchanged, already saved as {}".format(saved_path))
+		return saved_path
+
+	def _write_buffer(self):
+		'''The calling thread's copy buffer, reused from one download to the next.'''
+		buffer = getattr(self._buffers, 'view', None)
+		if buffer is None or len(buffer) != self.context.write_buffer_size:
+			buffer = memoryview(bytearray(self.context.write_buffer_size))
+			self._buffers.view = buffer
+		return buffer
+
+	def _resumable_part(self, url, part_path):
+		"""
+		The record of part_path if it is a partial download of url that can
+		be resumed, otherwise None.  A .part left by another URL, or with no
+		validator to send in If-Range, is removed.  So is one fetched in
+		segments, which has holes until every range is in.
+		"""
+		if not os.path.exists(part_path):
+			self._drop_part(part_path)
+			return None
+		try:
+			with open(part_path + PART_INFO_SUFFIX, 'r') as f:
+				info = json.load(f)
+		except (OSError, ValueError):
+			info = None
+		if info is None or info.get('url') != url or not if_range(info) or 'received' not in info:
+			print ("    Discarding {}, it cannot be resumed".format(part_path))
+			self.context.metrics.add('parts_discarded')
+			self._drop_part(part_path)
+			return None
+		return info
+
+	def _write_part_info(self, part_path, info):
+		info_path = part_path + PART_INFO_SUFFIX
+		with open(info_path + '.tmp', 'w') as f:
+			json.dump(info, f)
+		os.replace(info_path + '.tmp', info_path)
+
+	def _drop_part(self, part_path):
+		'''Remove a .part file and its record, whichever exist.'''
+		for path in (part_path, part_path + PART_INFO_SUFFIX):
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+
+	def _sniff(self, url, headers, head):
+		'''sniff_media() on the start of a body, with the error set if it is not media.'''
+		try:
+			return sniff_media(headers.get('Content-Type'), bytes(head))
+		except NotMedia as ex:
+			self.context.metrics.add('not_media', domain=url_domain(url))
+			self.saved_post.set_error("{}: {}".format(url, ex))
+			raise
+
+	def _fetch_to_part(self, url, part_path, conditions=None):
+		"""
+		Fetch url into part_path.  Data already in part_path, left by an
+		interrupted download of the same URL, is kept and the rest
+		requested with a Range header, with If-Range so that a file that
+		has changed since is sent whole instead.  Transfers that break off
+		are resumed the same way if the server accepts ranges and restarted
+		if not.  'conditions' are
+		If-None-Match / If-Modified-Since headers for a fresh fetch, and
+		NotModified is raised if the server answers 304.
+		The start of a fresh fetch is checked with sniff_media() before
+		anything is written, and NotMedia raised for a page.
+		When the server gives the length the file is preallocated, so its
+		size says nothing about how much has arrived.  That is kept in the
+		.part record instead, updated every PART_PROGRESS_INTERVAL bytes
+		once they are in the file, and resuming starts from there even
+		after the process was killed.
+		Returns the (sha256 hex digest, size, response headers, extension
+		found by sniff_media or None) of the whole file.
+		"""
+		domain = url_domain(url)
+		accepts_ranges = True
+		for attempt in range(DOWNLOAD_RETRIES + 1):
+			offset = 0
+			info = self._resumable_part(url, part_path) if accepts_ranges else None
+			if info is not None:
+				offset = min(info['received'], os.path.getsize(part_path))
+			# Media is already compressed.  Asking for it as is keeps byte
+			# ranges and Content-Length about the bytes written to disk.
+			headers = { 'Accept-Encoding': 'identity' }
+			if offset:
+				headers['Range'] = 'bytes={}-'.format(offset)
+				headers['If-Range'] = if_range(info)
+			elif conditions:
+				headers.update(conditions)
+			rv = self.context.transport.get(url, stream=True, headers=headers)
+			try:
+				if rv.status_code == 304 and not offset and conditions:
+					self.context.metrics.add('not_modified', domain=domain)
+					raise NotModified()
+				if rv.status_code == 416 and offset:
+					# What we have does not fit what the server has now.
+					self._drop_part(part_path)
+					continue
+				if rv.status_code == 206 and offset:
+					if content_range_start(rv.headers.get('Content-Range')) != offset:
+						# Not the rest of what we have.  Start again.
+						self._drop_part(part_path)
+						continue
+					mode = 'r+b'
+				elif rv.status_code == 200:
+					(mode, offset) = ('wb', 0)
+				else:
+					self.saved_post.set_error("Request to {} returned code {}".format(url, rv.status_code))
+					print (f"   HTTP get returned {rv.status_code}")
+					raise DownloaderException()
+				accepts_ranges = rv.headers.get('Accept-Ranges', '').lower() == 'bytes' or rv.status_code == 206
+				length = rv.headers.get('Content-Length')
+				expected = offset + int(length) if length is not None else None
+				rv.raw.decode_content = True
+				buffer = self._write_buffer()
+				filled = 0
+				kind = None
+				if not offset:
+					# Look at what came back before writing any of it, so an
+					# error page is never saved as media.  A page is given up on
+					# without reading the rest of it.
+					if media_type(rv.headers.get('Content-Type')) not in PAGE_TYPES:
+						filled = read_head(rv.raw, buffer)
+					kind = self._sniff(url, rv.headers, buffer[:filled])
+					if filled == SNIFF_SIZE:
+						# Top the buffer up so the first write is a full one.
+						filled += rv.raw.readinto(buffer[filled:])
+					# Remember what this is, so only the same file of the same
+					# URL is ever resumed into it.
+					info = { 'url': url, 'etag': rv.headers.get('ETag'),
+							 'last_modified': rv.headers.get('Last-Modified'), 'received': 0 }
+					self._write_part_info(part_path, info)
+
+				# Hash the content as it is copied so duplicates can be found
+				# without reading the file a second time.  Only a resumed
+				# prefix has to be read back.
+				hasher = hashlib.sha256()
+				if offset:
+					self._hash_file(part_path, hasher, offset)
+				size = offset
+				start = time.perf_counter()
+				write_time = 0.0
+				try:
+					with open(part_path, mode) as f:
+						f.seek(offset)
+						if self.context.preallocate and expected is not None:
+							preallocate_file(f, expected - offset)
+						recorded = offset
+
+						def progress(copied):
+							# Only bytes already handed to the OS are counted, so
+							# the record never runs ahead of the file.
+							nonlocal recorded
+							if offset + copied - recorded >= PART_PROGRESS_INTERVAL:
+								f.flush()
+								recorded = offset + copied
+								self._write_part_info(part_path, dict(info, received=recorded))
+
+						try:
+							(_, write_time) = copy_stream(rv.raw, f, buffer, hasher, filled, progress=progress)
+						finally:
+							size = f.tell()
+							# Drop preallocated space, or data past a resume
+							# point, that was never written this time.
+							f.truncate(size)
+							self._write_part_info(part_path, dict(info, received=size))
+				finally:
+					self.context.metrics.add('bytes', size - offset, domain=domain)
+					self.context.metrics.observe('transfer', time.perf_counter() - start, domain=domain)
+					self.context.metrics.observe('disk_write', write_time, domain=domain)
+				if expected is not None and size != expected:
+					raise DownloadInterrupted("got {} of {} bytes".format(size, expected))
+				return (hasher.hexdigest(), size, rv.headers, kind)
+			except RETRYABLE_ERRORS as ex:
+				if attempt == DOWNLOAD_RETRIES:
+					raise
+				self.context.metrics.add('retries', domain=domain)
+				print ("    Transfer interrupted ({}), {}".format(ex, "resuming" if accepts_ranges else "restarting"))
+				time.sleep(attempt + 1)
+			finally:
+				rv.close()
+		raise DownloaderException("Could not download {}".format(url))
+
+	def _segment_head(self, url, conditions=None):
+		"""
+		Ask the server about a file before fetching it.  Returns the HEAD
+		response headers if it is big enough to fetch in segments and the
+		server accepts byte ranges, otherwise None.  Raises NotModified if
+		'conditions' show the saved copy is still current.
+		"""
+		if self.context.segment_count < 2:
+			return None
+		headers = { 'Accept-Encoding': 'identity' }
+		headers.update(conditions or {})
+		try:
+			rv = self.context.transport.head(url, headers=headers)
+			rv.close()
+		except requests.exceptions.RequestException:
+			return None
+		if rv.status_code == 304 and conditions:
+			raise NotModified()
+		if rv.status_code != 200 or rv.headers.get('Accept-Ranges', '').lower() != 'bytes':
+			return None
+		if media_type(rv.headers.get('Content-Type')) in PAGE_TYPES:
+			# Let the plain fetch find out what this is and report it.
+			return None
+		length = rv.headers.get('Content-Length')
+		if length is None or int(length) < self.context.segment_threshold:
+			return None
+		return rv.headers
+
+	def _fetch_segmented(self, url, part_path, total, validator=None):
+		"""
+		Fetch url as segment_count byte ranges at the same time, each
+		written into its own place in a file of the full size.  Each range
+		is asked for with If-Range 'validator', from the HEAD response, so
+		that ranges of different versions are never put together.  The
+		first range is checked with sniff_media() before the file is made
+		or the other ranges asked for.  The .part has holes until the end,
+		so it is given no record and a later run starts it again rather
+		than resuming it.
+		Returns the (sha256 hex digest, size, extension found by
+		sniff_media) of the file.
+		"""
+		step = -(-total // self.context.segment_count)
+		ranges = [ (start, min(start + step, total) - 1) for start in range(0, total, step) ]
+		print ("    Fetching {} bytes in {} segments".format(total, len(ranges)))
+		domain = url_domain(url)
+		created = threading.Event()
+		with self.context.metrics.timer('transfer', domain=domain):
+			with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+				(start, end) = ranges[0]
+				first = pool.submit(self._fetch_range, url, part_path, start, end, validator, created, total)
+				first.add_done_callback(lambda f: created.set())
+				created.wait()
+				if first.done():
+					# Failed, or not media, before the rest were needed.
+					first.result()
+				futures = [ first ] + [ pool.submit(self._fetch_range, url, part_path, start, end, validator)
+										for (start, end) in ranges[1:] ]
+				for f in futures:
+					f.result()
+		# Segments arrive out of order so the hash needs its own pass.
+		hasher = hashlib.sha256()
+		with self.context.metrics.timer('hash'):
+			self._hash_file(part_path, hasher)
+		return (hasher.hexdigest(), total, first.result())
+
+	def _fetch_range(self, url, part_path, start, end, validator=None, created=None, total=None):
+		"""
+		Fetch bytes start to end (inclusive) of url into the same place in
+		part_path.  Given 'created', an Event, this is the first range: what
+		comes back is sniffed before part_path is made 'total' bytes long,
+		then created is set.  Returns the extension sniff_media found, if
+		it was asked.
+		"""
+		domain = url_domain(url)
+		kind = None
+		pos = start
+		for attempt in range(DOWNLOAD_RETRIES + 1):
+			headers = { 'Accept-Encoding': 'identity', 'Range': 'bytes={}-{}'.format(pos, end) }
+			if validator:
+				headers['If-Range'] = validator
+			rv = self.context.transport.get(url, stream=True, headers=headers)
+			try:
+				if rv.status_code != 206:
+					raise DownloaderException("Range request to {} returned code {}".format(url, rv.status_code))
+				if content_range_start(rv.headers.get('Content-Range')) != pos:
+					raise DownloaderException("Range request to {} returned {}".format(
+						url, rv.headers.get('Content-Range')))
+				buffer = self._write_buffer()
+				filled = 0
+				if created is not None and not created.is_set():
+					filled = read_head(rv.raw, buffer)
+					kind = self._sniff(url, rv.headers, buffer[:filled])
+					with open(part_path, 'wb') as f:
+						if not (self.context.preallocate and preallocate_file(f, total)):
+							f.truncate(total)
+					created.set()
+				received = pos
+				try:
+					with open(part_path, 'r+b') as f:
+						f.seek(pos)
+						try:
+							copy_stream(rv.raw, f, buffer, filled=filled, limit=end - pos + 1)
+						finally:
+							pos = f.tell()
+				finally:
+					self.context.metrics.add('bytes', pos - received, domain=domain)
+				if pos <= end:
+					raise DownloadInterrupted("segment stopped at {} of {}-{}".format(pos, start, end))
+				return kind
+			except RETRYABLE_ERRORS as ex:
+				if attempt == DOWNLOAD_RETRIES:
+					raise
+				self.context.metrics.add('retries', domain=domain)
+				print ("    Segment interrupted ({}), resuming".format(ex))
+				time.sleep(attempt + 1)
+			finally:
+				rv.close()
+
+	def _resolve(self, page_url, resolver, fresh=False):
+		"""
+		Find the media URL(s) a page leads to.  resolver(page_url) does the
+		work and returns a list of URLs, or None with the error set.
+		Answers are kept in the resolve cache so cross-posts and later runs
+		go straight to the media.
+		Returns (urls, True if they came from the cache).
+		"""
+		cache = self.context.resolve_cache
+		if cache is not None and not fresh:
+			urls = cache.get_resolved(page_url, self.context.resolve_ttl)
+			if urls:
+				self.context.metrics.add('resolve_cache', result='hit')
+				return (urls, True)
+			self.context.metrics.add('resolve_cache', result='miss')
+		with self.context.metrics.timer('resolve', downloader=type(self).__name__):
+			urls = resolver(page_url)
+		if urls and cache is not None:
+			cache.put_resolved(page_url, urls, self.context.resolve_max_entries)
+		return (urls, False)
+
+	def _download_resolved(self, page_url, resolver):
+		"""
+		Resolve page_url and download the media it leads to as the post.
+		A URL from the cache that no longer works is forgotten and the
+		page resolved again.
+		"""
+		(urls, cached) = self._resolve(page_url, resolver)
+		if not urls:
+			return
+		try:
+			try:
+				file_path = self._download_to_file(urls[0], self.saved_post.base_path)
+			except DownloaderException:
+				if not cached:
+					raise
+				print ("    Cached media URL failed, resolving {} again".format(page_url))
+				self.context.resolve_cache.drop_resolved(page_url)
+				(urls, cached) = self._resolve(page_url, resolver, fresh=True)
+				if not urls:
+					return
+				file_path = self._download_to_file(urls[0], self.saved_post.base_path)
+			self.saved_post.set_saved(file_path)
+		except Exception as ex:
+			self.saved_post.set_exception(ex)
+			traceback.print_exc()
+
+	def _choose_rendition(self, renditions):
+		"""
+		HEAD each version of a video and pick one by rendition_policy.
+		Versions that do not answer 200, are pages or are empty are
+		dropped before any body is fetched.  Returns the chosen Rendition,
+		or None with the error set if none is usable.
+		"""
+		if len(renditions) == 1:
+			# Nothing to choose between, and the fetch checks what it gets.
+			return renditions[0]
+		with ThreadPoolExecutor(max_workers=max(1, min(len(renditions), RENDITION_PROBES))) as pool:
+			usable = [ r for (r, ok) in zip(renditions, pool.map(self._probe_rendition, renditions)) if ok ]
+		self.context.metrics.add('renditions', len(renditions) - len(usable), result='rejected')
+		if not usable:
+			self.saved_post.set_error("No usable video among {} sources".format(len(renditions)))
+			return None
+
+		unknown = float('inf')
+		by_size = lambda r: r.size if r.size is not None else unknown
+		policy = self.context.rendition_policy
+		if policy == 'smallest':
+			chosen = min(usable, key=by_size)
+		elif policy == 'max_size':
+			limit = self.context.rendition_max_mb * 1024 * 1024
+			fits = [ r for r in usable if r.size is not None and r.size <= limit ]
+			chosen = max(fits, key=Rendition.quality) if fits else min(usable, key=by_size)
+		elif policy == 'max_resolution':
+			fits = [ r for r in usable if r.height is not None and r.height <= self.context.rendition_max_height ]
+			chosen = max(fits, key=Rendition.quality) if fits else min(usable, key=by_size)
+		else:
+			chosen = max(usable, key=Rendition.quality)
+		self.context.metrics.add('renditions', result='chosen')
+		if len(renditions) > 1:
+			print ("    Chose {} ({} bytes) of {} sources".format(chosen.url, chosen.size, len(renditions)))
+		return chosen
+
+	def _probe_rendition(self, rendition):
+		'''HEAD a version of a video.  Returns False if it is no good.'''
+		try:
+			rv = self.context.transport.head(rendition.url, headers={ 'Accept-Encoding': 'identity' })
+			rv.close()
+		except requests.exceptions.RequestException as ex:
+			print ("    Skipping {}: {}".format(rendition.url, ex))
+			return False
+		if rv.status_code != 200 or media_type(rv.headers.get('Content-Type')) in PAGE_TYPES:
+			print ("    Skipping {}: {} {}".format(rendition.url, rv.status_code, rv.headers.get('Content-Type', '')))
+			return False
+		rendition.size = int_or_none(rv.headers.get('Content-Length'))
+		if rendition.size == 0:
+			print ("    Skipping {}: empty".format(rendition.url))
+			return False
+		return True
+
+	def _find_in_page(self, url, target):
+		"""
+		Fetch a page and find the elements described by an
+		htmlextract.Target in it.  Returns a list of elements, or None
+		(with the error set) if the page could not be fetched.
+		"""
+		rv = self.context.transport.get(url, stream=True)
+		try:
+			if rv.status_code != 200:
+				self.saved_post.set_error(f"HTTP get returned {rv.status_code}")
+				return None
+			with self.context.metrics.timer('page', domain=url_domain(url)):
+				return htmlextract.extract(rv, target)
+		finally:
+			rv.close()
+
+	def _hash_file(self, path, hasher, length=None):
+		'''Add the first 'length' bytes of a file, or all of it, to hasher.'''
+		left = length
+		with open(path, 'rb') as f:
+			while left is None or left > 0:
+				chunk = f.read(COPY_CHUNK_SIZE if left is None else min(COPY_CHUNK_SIZE, left))
+				if not chunk:
+					break
+				hasher.update(chunk)
+				if left is not None:
+					left -= len(chunk)
+
+	def _dedup(self, file_path, digest, size):
+		"""
+		Look the content up in the hash index.  If it has been saved before
+		replace the new copy with a hard link to the original (or just drop
+		it) and return the path the content is now at.
+		"""
+		if self.context.hash_index is None:
+			return file_path
+		original = self.context.hash_index.claim_hash(digest, file_path, size)
+		if original is None or original == file_path:
+			return file_path
+
+		print ("    Duplicate of {}".format(original))
+		self.context.metrics.add('duplicates', action=self.context.dedup)
+		if self.context.dedup == 'drop':
+			os.remove(file_path)
+			self.saved_post.add_duplicate(file_path, original)
+			return original
+		try:
+			# Link beside the copy first so the name is never missing.
+			link_path = file_path + '.link'
+			os.link(original, link_path)
+			os.replace(link_path, file_path)
+			self.saved_post.add_duplicate(file_path, original)
+		except OSError as ex:
+			# Different file system, or links not supported.  Keep the copy.
+			print ("    Could not link to duplicate: {}".format(ex))
 		return file_path
 
 	def download(self):
@@ -242,7 +1297,10 @@ class Downloader(object):
 
 
 
+DOWNLOADERS = DownloaderRegistry(Downloader)
 
+
+@DOWNLOADERS.register(extensions=IMAGE_FORMATS + VIDEO_FORMATS)
 class DirectDownloader(Downloader):
 	'''Download from a direct link to the media file.'''
 	def download(self):
@@ -257,76 +1315,98 @@ class DirectDownloader(Downloader):
 			traceback.print_exc()
 
 
-class ImagureAlbumDownloader():
+@DOWNLOADERS.register(domains=['imgur.com'], pattern='/a/')
+class ImagureAlbumDownloader(Downloader):
+	BLOG_IMAGES = htmlextract.Target("a", {"class": "zoom"}, many=True,
+									 within=htmlextract.Target("div", {"id": "image-container"}))
+
 	def download(self):
 		"""
 		Album from imgur
 		"""
-		download_url = 'http://s.imgur.com/a/%s/zip' % \
-			(os.path.split(self.submission.url)[1])
-		headers = make_headers(download_url)
+		album_id = os.path.split(self.submission.url)[1]
+		if '#' in album_id:
+			album_id = album_id[0:album_id.index("#")]
+		# The id keeps albums whose titles start the same apart, since what
+		# is already in the folder counts as downloaded below.
+		path = os.path.join(self.album_path, "{}_{}".format(self.submission.title[0:50].replace("/", ""), album_id))
+		os.makedirs(path, exist_ok=True)
+
+		download_url = 'http://s.imgur.com/a/%s/zip' % (album_id)
 		try:
-			response = requests.get(download_url, headers=headers)
-		except Exception as ex:
-			self.saved_post.set_exception(str(ex))
-			traceback.print_exc()
-			return
-
-		path = os.path.join(ALBUM_PATH, self.submission.title
-							.encode('utf-8')[0:50].replace("/", ""))
-		# extract zip
-		if not os.path.exists(path):
-			os.mkdir(path)
-		try:
-			# i = open(path + '.zip', 'w')
-			# i.write(StringIO(response.content))
-			# i.close()
-			zipfile = ZipFile(BytesIO(response.content))
-			zipfile.extractall(path)
+			self._extract_zip(download_url, path)
 			print ("  > {}".format(path))
 			self.saved_post.set_saved(path)
+			return
 		except Exception as ex:  # big album
-			try:
-				os.remove(path + '.zip')
-			except OSError as ex:
-				pass
 			#print("Exception: {0}".format(str(ex)))
 			print("  Album is too big, downloading images...")
-			# this is the best layout
-			idimage = os.path.split(self.submission.url)[1]
-			if '#' in idimage:
-				print("  (# in idimage)")
-				idimage = idimage[0:idimage.index("#")]
-			url = "http://imgur.com/a/%s/layout/blog" % (idimage)
-
-			headers=make_headers(url)
-			response = requests.get(url, headers=headers)
-			soup = bs(response.content)
-			container_element = soup.find("div", {"id": "image-container"})
-			try:
-				imgs_elements = container_element.findAll("a",
-														  {"class": "zoom"})
-			except Exception as ex:
-				self.saved_post.set_exception(str(ex))
-				return
-			counter = 0
-			for img in imgs_elements:
-				counter
-				img_url = img.attrs['href']
+
+		# this is the best layout
+		url = "http://imgur.com/a/%s/layout/blog" % (album_id)
+		imgs_elements = self._find_in_page(url, self.BLOG_IMAGES)
+		if not imgs_elements:
+			self.saved_post.set_error("No images found in album")
+			return
+		img_urls = []
+		for img in imgs_elements:
+			img_url = img.attrs['href']
+			# damn weird links
+			if img_url.startswith('//'):
+				img_url = "http:{0}".format(img_url)
+			img_urls.append(img_url)
+
+		# Images are named by their place in the album so they keep their
+		# order however they finish.  Ones already there from an interrupted
+		# run are not fetched again.
+		todo = [ (counter, img_url) for (counter, img_url) in enumerate(img_urls)
+				 if not self._album_image_exists(os.path.join(path, str(counter))) ]
+		if len(todo) < len(img_urls):
+			print("    {} of {} images already saved".format(len(img_urls) - len(todo), len(img_urls)))
+
+		def fetch(item):
+			(counter, img_url) = item
+			print("    {0}".format(img_url))
+			return self._download_to_file(img_url, os.path.join(path, str(counter)))
+
+		failed = False
+		with ThreadPoolExecutor(max_workers=ALBUM_WORKERS) as pool:
+			for f in [ pool.submit(fetch, item) for item in todo ]:
 				try:
-					# damn weird links
-					if img_url.startswith('//'):
-						img_url = "http:{0}".format(img_url)
-					print("    {0}".format(img_url))
-					self._download_to_file(img_url, os.path.join(path, str(counter)))
+					f.result()
 				except Exception as ex:
 					self.saved_post.set_exception(str(ex))
 					traceback.print_exc()
-					return
-				counter += 1
-		self.saved_post.set_saved(path)
+					failed = True
+		if not failed:
+			self.saved_post.set_saved(path)
+
+	def _extract_zip(self, url, path):
+		"""
+		Stream the album zip into a temporary file which only stays in
+		memory while it is small, then extract it member by member.
+		"""
+		rv = self.context.transport.get(url, stream=True)
+		try:
+			if rv.status_code != 200:
+				raise DownloaderException("Request to {} returned code {}".format(url, rv.status_code))
+			domain = url_domain(url)
+			with tempfile.SpooledTemporaryFile(max_size=ALBUM_SPOOL_SIZE) as spool:
+				with self.context.metrics.timer('transfer', domain=domain):
+					for chunk in rv.iter_content(COPY_CHUNK_SIZE):
+						spool.write(chunk)
+				self.context.metrics.add('bytes', spool.tell(), domain=domain)
+				spool.seek(0)
+				with ZipFile(spool) as zipfile:
+					zipfile.extractall(path)
+		finally:
+			rv.close()
+
+	def _album_image_exists(self, path_base):
+		return any(not is_partial(p) for p in glob(glob_escape(path_base) + '.*'))
 
 
+@DOWNLOADERS.register(domains=['imgur.com'])
 class ImagureLinkDownloader(Downloader):
 	'''
         	<video poster="//i.imgur.com/ebQD4MQh.jpg"
@@ -341,14 +1421,14 @@ class ImagureLinkDownloader(Downloader):
 
 	'''
 
-	def _find_video_link(self, soup):
-		divnode = soup.find_all('div', { 'class': 'video-elements' })
-		if not divnode or len(divnode) == 0:
-			return None
-		srcnode = divnode[0].find_all('source')
+	VIDEO_SOURCE = htmlextract.Target('source', within=htmlextract.Target('div', { 'class': 'video-elements' }))
+
+	def _find_video_link(self, url):
+		srcnode = self._find_in_page(url, self.VIDEO_SOURCE)
 		if not srcnode:
+			self.saved_post.set_error("Failed to find Imagur link")
 			return None
-		return srcnode[0].attrs['src']
+		return [ "http:" + srcnode[0].attrs['src'] ]
 
 		
 
@@ -358,39 +1438,25 @@ class ImagureLinkDownloader(Downloader):
 		"""
 		# just a hack. i dont know if this will be a .jpg, but in order to
 		# download an image data, I have to write an extension
-		headers=make_headers(self.submission.url)
-		r = requests.get(self.submission.url, headers=headers)
-		soup = bs(r.text, features="html.parser")
-		if self.submission.url.endswith('gifv'):
-			media_url = self._find_video_link(soup)
-		else:
+		if not self.submission.url.endswith('gifv'):
 			self.saved_post.set_error("Unknown Imagur link type")
 			return		
-		if not media_url:
-			self.saved_post.set_error("Failed to find Imagur link")
-			return
-
-		media_url = "http:" + media_url
-		try:
-			file_path = self._download_to_file(media_url, self.saved_post.base_path)
-			self.saved_post.set_saved(file_path)
-		except Exception as ex:
-			self.saved_post.set_exception(ex)
-			traceback.print_exc()
+		self._download_resolved(self.submission.url, self._find_video_link)
 
 
 
+@DOWNLOADERS.register(domains=['tumblr.com'], experimental=True)
 class TumblrDownloader(Downloader):
+	IMAGES = htmlextract.Target("img", { "src": lambda src: "media.tumblr.com/tumblr_" in src }, many=True)
+
 	def download(self):
 		"""
 		Tumblr image link
 		"""
-		response = requests.get(self.submission.url)
-		soup = bs(response.content, features="html.parser")
+		img_elements = self._find_in_page(self.submission.url, self.IMAGES) or []
 		# div = soup.find("div", {'class': 'post'})
 		# if not div:
 		#     div = soup.find("li", {'class': 'post'})
-		img_elements = soup.findAll("img")
 		for img in img_elements:
 			if "media.tumblr.com/tumblr_" in img.attrs['src']:
 				img_url = img.attrs['src']
@@ -404,16 +1470,21 @@ class TumblrDownloader(Downloader):
 		self.saved_post.set_saved(self.saved_post.base_path)
 
 
+@DOWNLOADERS.register(domains=['flickr.com'], experimental=True)
 class FlickrDownloader(Downloader):
+	PHOTO = htmlextract.Target("img", within=htmlextract.Target("div", {"class": "photo-div"}))
+
 	def download(self):
 		"""
 		Flickr image link
 		"""
-		response = requests.get(self.submission.url)
-		soup = bs(response.content, features="html.parser")
-		div_element = soup.find("div", {"class": "photo-div"})
-		img_element = div_element.find("img")
-		img_url = img_element.attrs['src']
+		img_elements = self._find_in_page(self.submission.url, self.PHOTO)
+		if img_elements is None:
+			return
+		if not img_elements:
+			self.saved_post.set_error("flickr photo not found")
+			return
+		img_url = img_elements[0].attrs['src']
 		try:
 			file_path = self._download_to_file(img_url, self.saved_post.base_path)
 			self.saved_post.set_saved(file_path)
@@ -421,60 +1492,117 @@ class FlickrDownloader(Downloader):
 			self.saved_post.set_exception(ex)
 			traceback.print_exc()
 
+@DOWNLOADERS.register(domains=['redgifs.com'], experimental=True)
 class RedgifsDownloader(Downloader):
+	LD_JSON = htmlextract.Target("script", {"type": "application/ld+json"}, text=True)
+
 	def download(self):
 		"""
 		Redgifs link
 		"""
-		response = requests.get(self.submission.url)
-		soup = bs(response.content, features="html.parser")
-		element = soup.find("script", {"type": "application/ld+json"})
-		if element is None:
+		self._download_resolved(self.submission.url, self._content_url)
+
+	def _content_url(self, url):
+		'''Get the video URL from the JSON-LD in a redgifs page.'''
+		elements = self._find_in_page(url, self.LD_JSON)
+		if elements is None:
+			return None
+		if not elements:
 			err = "redgifs failed to find script element"
-			self.saved_post.set_error(f"{err} ({self.submission.url})")
+			self.saved_post.set_error(f"{err} ({url})")
 			print ("   " + err)
-			return
-		jobj = json.loads(element.text)
+			return None
+		jobj = json.loads(elements[0].text)
 		if jobj is None:
 			err = "redgifs failed to parse json"
 			self.saved_post.set_error(err)
 			print ("   " + err)
-			return
+			return None
 		video = jobj['video']
 		if video is None:
 			err = "redgifs json had no 'video' element"
 			self.saved_post.set_error(err)
 			print ("   " + err)
-			return
+			return None
 		img_url = html.unescape(video['contentUrl'])
 		if img_url is None:
 			err = "redgifs json had no 'contentUrl' element"
 			self.saved_post.set_error(err)
 			print ("   " + err)
-			return
-		try:
-			file_path = self._download_to_file(img_url, self.saved_post.base_path)
-			self.saved_post.set_saved(file_path)
-		except Exception as ex:
-			self.saved_post.set_exception(ex)
-			traceback.print_exc()
+			return None
+		renditions = [ Rendition(img_url, video.get('width'), video.get('height')) ]
+		if self.context.rendition_policy != 'best' and img_url.endswith('.mp4') and not img_url.endswith('-mobile.mp4'):
+			# redgifs also keeps a smaller copy for phones beside each video.
+			renditions.append(Rendition(img_url[:-len('.mp4')] + '-mobile.mp4'))
+		chosen = self._choose_rendition(renditions)
+		if chosen is None:
+			return None
+		return [ chosen.url ]
 
 
+@DOWNLOADERS.register(domains=['reddit.com'], pattern='/gallery/', experimental=True)
 class ReditGalleryDownloader(Downloader):
+	PREVIEW_LINKS = htmlextract.Target("a", { "href": re.compile("preview.redd.it") }, many=True)
+
 	def download(self):
 		"""
-		Flickr image link
+		Reddit gallery
 		"""
-		print (f"    fetching gallery {self.submission.url}")
-		time.sleep(2.0)
-		response = requests.get(self.submission.url)
-		if response.status_code != 200:
-			self.saved_post.set_error(f"HTTP get returned {response.status_code}")
+		items = self._gallery_items()
+		if items is None:
+			self._download_from_page()
 			return
 
-		soup = bs(response.content, features="html.parser")
+		# Take the names in gallery order first so that the files are
+		# numbered in that order however the downloads finish.
+		paths = [ self._mk_unique_name(self.saved_post.base_path + ext) for (url, ext) in items ]
+		print (f"    gallery of {len(items)} images")
+		with ThreadPoolExecutor(max_workers=ALBUM_WORKERS) as pool:
+			futures = [ pool.submit(self._download_to_path, url, path)
+						for ((url, ext), path) in zip(items, paths) ]
+			files = []
+			for f in futures:
+				try:
+					files.append(f.result())
+				except Exception as ex:
+					self.saved_post.set_exception(ex)
+		if len(files) == len(items):
+			self.saved_post.set_saved(":".join(files))
+
+	def _gallery_items(self):
+		"""
+		Get (url, extension) of the original of each gallery image, in
+		order, from the gallery_data and media_metadata that came with the
+		listing.  Returns None if they are not there.
+		"""
+		# Look in the submission's own attributes.  Going through getattr
+		# would make praw fetch the whole submission when one is missing.
+		data = vars(self.submission)
+		if not data.get('gallery_data') and data.get('crosspost_parent_list'):
+			data = data['crosspost_parent_list'][0]
+		gallery = data.get('gallery_data')
+		metadata = data.get('media_metadata')
+		if not gallery or not metadata:
+			return None
+
+		items = []
+		for item in gallery.get('items', []):
+			meta = metadata.get(item.get('media_id'))
+			if not meta or meta.get('status') != 'valid' or 'm' not in meta:
+				continue
+			ext = meta['m'].split('/')[-1]
+			if ext == 'jpeg':
+				ext = 'jpg'
+			items.append(("https://i.redd.it/{}.{}".format(item['media_id'], ext), '.' + ext))
+		return items or None
+
+	def _download_from_page(self):
+		'''Find the images by scraping the gallery page.'''
+		print (f"    fetching gallery {self.submission.url}")
+		elements = self._find_in_page(self.submission.url, self.PREVIEW_LINKS)
+		if elements is None:
+			return
 
-		elements = soup.find_all("a", href=re.compile("preview.redd.it"))
 		links = [] 
 
 		try:
@@ -497,6 +1625,7 @@ class ReditGalleryDownloader(Downloader):
 		self.saved_post.set_saved(":".join(files))
 
 
+@DOWNLOADERS.register(domains=['picsarus.com'], experimental=True)
 class PicsarusDownloader(Downloader):
 	def download(self):
 		"""
@@ -510,15 +1639,21 @@ class PicsarusDownloader(Downloader):
 			traceback.print_exc()
 
 
+@DOWNLOADERS.register(domains=['picasaurus.com'], experimental=True)
 class PicasaurusDownloader(Downloader):
+	PHOTO = htmlextract.Target("img", {"class": "photoQcontent"})
+
 	def download(self):
 		"""
 		Picasaurus image link
 		"""
-		response = requests.get(self.submission.url)
-		soup = bs(response.content)
-		img = soup.find("img", {"class": "photoQcontent"})
-		img_url = img.attrs['src']
+		imgs = self._find_in_page(self.submission.url, self.PHOTO)
+		if imgs is None:
+			return
+		if not imgs:
+			self.saved_post.set_error("picasaurus photo not found")
+			return
+		img_url = imgs[0].attrs['src']
 		try:
 			file_path = self._download_to_file(img_url, self.saved_post.base_path)
 			self.saved_post.set_saved(file_path)
@@ -527,34 +1662,46 @@ class PicasaurusDownloader(Downloader):
 			traceback.print_exc()
 
 
+@DOWNLOADERS.register(domains=['gfycat.com'])
 class GyfcatRedgisDownloader(Downloader):
+	"""
+	gfycat pages now lead to redgifs, which saves the video.  A page whose
+	canonical link is still on gfycat is saved from its own video sources
+	by GyfcatDownloader.
+	"""
+	media_domain = 'redgifs.com'
+	CANONICAL = htmlextract.Target("link", { "rel": "canonical" })
+
 	def download(self):
-		r = requests.get(self.submission.url)
-		if r.status_code != 200:
-			self.saved_post.set_error(f"HTTP get returns status {r.status_code}")
+		(links, _) = self._resolve(self.submission.url, self._canonical_link)
+		if not links:
 			return
-
-		soup = bs(r.text, features="html.parser")
-
-		redirect_link = soup.find("link", rel="canonical" )
-		if redirect_link is None:
-			self.saved_post.set_error(f"No redirect link found")
-			return			
 			
-		link = redirect_link['href']
+		link = links[0]
+		if ('.' + url_domain(link)).endswith('.gfycat.com'):
+			# Still on gfycat, which serves the video itself.
+			GyfcatDownloader(self.saved_post, self.context).download()
+			return
 		print (f"    Redirected to {link}")
 		self.submission.url = link
 
-		reddl = RedgifsDownloader(self.saved_post)
+		reddl = RedgifsDownloader(self.saved_post, self.context)
 
 		reddl.download()
 
 
+	def _canonical_link(self, url):
+		redirect_links = self._find_in_page(url, self.CANONICAL)
+		if redirect_links is None:
+			return None
+		if not redirect_links:
+			self.saved_post.set_error(f"No redirect link found")
+			return None
+		return [ redirect_links[0]['href'] ]
+
+
 class GyfcatDownloader(Downloader):
 	def download(self):
-		r = requests.get(self.submission.url)
-		soup = bs(r.text, features="html.parser")
-
 		# make tag.  Get the last component of URL.
 		url_parts = urllib.parse.urlparse(self.submission.url)
 		parts = url_parts.path.split('/')
@@ -562,171 +1709,436 @@ class GyfcatDownloader(Downloader):
 		parts = vn.split('-')
 		vn = parts[0]
 		videotag = 'video-' + vn.lower()
-		video_path = ""
-		
-		videonode = soup.find_all('video', id=videotag)
-		if len(videonode) < 1:
+
+		sources = self._find_in_page(self.submission.url, htmlextract.Target(
+			'source', { 'type': 'video/mp4' }, many=True, within=htmlextract.Target('video', { 'id': videotag })))
+		if sources is None:
+			return
+		renditions = [ Rendition(source['src'], source.get('width'), source.get('height'))
+					   for source in sources if 'thumbs' not in source['src'] ]
+		if not renditions:
 			self.saved_post.set_error("gyfcat.com: failed to find 'video' node with tag '{}'".format(videotag))
 			return
-		if len(videonode) > 1:
-			self.saved_post.set_error("gyfcat.com: found {} 'video' nodes with tag '{}'".format(len(videonode), videotag))
+
+		# Only the chosen version is fetched, not every source in turn.
+		chosen = self._choose_rendition(renditions)
+		if chosen is None:
 			return
-			
-		srcCount = 0
 		print ("    Saving video to:")
-		for videosource in videonode[0].find_all('source', type="video/mp4"):
-			src_url = videosource.attrs['src']
-			if not 'thumbs' in src_url:
-				srcCount += 1
-				base_path = self.saved_post.base_path + '_' + str(srcCount)
-				video_path = self._download_to_file(src_url, base_path)
-				if os.path.getsize(video_path) == 0:
-					print ("ERROR:  zero size file")
-					self.saved_post.set_error("File was zero size - not downloaded")
-					return
-					
-		
-		r.close()
+		video_path = self._download_to_file(chosen.url, self.saved_post.base_path)
+		if os.path.getsize(video_path) == 0:
+			print ("ERROR:  zero size file")
+			self.saved_post.set_error("File was zero size - not downloaded")
+			return
 		self.saved_post.set_saved(video_path)
 
 
 
-def make_downloader(saved_post, is_expirmental=False):
+def make_downloader(saved_post, context, is_expirmental=False):
 	"""
 	This method allows to decide how to process the image
 	"""
-	is_broken = False
-	result = None
-	if is_image_link(saved_post.submission.url):
-		result = DirectDownloader(saved_post)
-	elif is_video_link(saved_post.submission.url):
-		result = DirectDownloader(saved_post)
-	else:
-		# not direct, read domain
-		if 'gfycat' in saved_post.submission.domain:
-			result = GyfcatRedgisDownloader(saved_post)
-		elif 'imgur' in saved_post.submission.domain:
-			# check if album
-			if '/a/' in saved_post.submission.url:
-				result = ImagureAlbumDownloader(saved_post)
-			else:
-				result = ImagureLinkDownloader(saved_post)
-		elif is_expirmental and 'redgifs' in saved_post.submission.domain:
-			result = RedgifsDownloader(saved_post)
-		elif is_expirmental and 'eddit.com/gallery' in saved_post.submission.url:
-			result = ReditGalleryDownloader(saved_post)
-		elif is_expirmental and 'tumblr' in saved_post.submission.domain:
-			result = TumblrDownloader(saved_post)
-		elif is_expirmental and 'flickr' in saved_post.submission.domain:
-			result = FlickrDownloader(saved_post)
-		elif is_expirmental and 'picsarus' in saved_post.submission.domain:
-			result = PicsarusDownloader(saved_post)
-		elif is_expirmental and 'picasaurus' in saved_post.submission.domain:
-			result = PicasaurusDownloader(saved_post)
-
-	return result
-
-
-
-def save_posts(R, username, save_dir, namer, limit=0, delay=0.0, is_unsave=True, is_expirmental=False):
-	print("Logging in...")
-	# create session
-	print (R.user.me())
-	print("Logged in.")
-	print("Getting data...")
-	# this returns a generator
-	red = R.redditor(username)
-	saved_posts = [ SavedPost(x, save_dir, namer) for x in red.saved(limit=None) ]
-	print ("{} posts found".format(len(saved_posts)))
-
-	count = 0
-	for sp in saved_posts:
-		# delete trailing slash
-		if sp.submission.url.endswith('/'):
-			sp.submission.url = sp.submission.url[0:-1]
-		print (f"{sp.submission.url} : {sp.submission.title}")
-		# create object per submission. Trusting garbage collector!
-		d = make_downloader(sp, is_expirmental=is_expirmental)
-		if d is None:
-			sp.set_notdone("Domain '{}' not supported".format(sp.submission.domain))
-		else:
-			try:
-				d.download()
-				count += 1
-			except Exception as e:
-				print (f"FAILED:  {str(e)}")
-				sp.status_code = sp.STATUS_EXCEPTION
-
-		if delay:
-			time.sleep(delay)
-
-		print (f"    Status: {sp.status_code} : {sp.error_message}")
-		if limit > 0 and count >= limit:
-			break
-
-	print("{} processed.".format(count))
-
-	# unsave items
-	if is_unsave:
-		for sp in saved_posts:
-			if sp.is_saved:
-				print("Unsaving {}".format(sp.submission.title))
-				sp.submission.unsave()
-				time.sleep(2)  # reddit's api restriction
-
-	for sp in saved_posts:
-		if not sp.is_saved:
-			print ("{1}: {2} - {0}".format(sp.submission.title, sp.status_code, sp.error_message))
+	cls = DOWNLOADERS.find(saved_post.submission.url, saved_post.submission.domain, is_expirmental)
+	return cls(saved_post, context) if cls is not None else None
 
 
+def media_host(saved_post, is_expirmental=False):
+	"""
+	The host a post's media will be fetched from, which is what the per
+	host caps count: the post's domain unless its downloader names another.
+	"""
+	cls = DOWNLOADERS.find(saved_post.submission.url, saved_post.submission.domain, is_expirmental)
+	return getattr(cls, 'media_domain', None) or saved_post.submission.domain
 
 
 
-CONFIG = open('config-mopaitai.yaml')
-CONFIG_DATA = yaml.safe_load(CONFIG)
-# user data
-USERNAME = CONFIG_DATA['username']
-PASSWORD = CONFIG_DATA['password']
-CLIENT_ID = CONFIG_DATA['client_id']
-CLIENT_SECRET = CONFIG_DATA['client_secret']
-USER_AGENT = CONFIG_DATA['user_agent']
-FOLLOWING = CONFIG_DATA['following']
-SAVE_DIR = os.path.expanduser(CONFIG_DATA['save_dir'])
-NAMER_MODULE = CONFIG_DATA['namer_module']
-DELAY = CONFIG_DATA.get('delay', 0.0)
+class UnsaveQueue(object):
+	"""
+	Unsaves posts on a background thread while downloads carry on.
+	Unsaves are paced by a token bucket sized to reddit's API allowance.
+	With a StateStore the queue is persisted, so posts downloaded before
+	a crash are unsaved by the next run.
+	"""
 
-#
-# Config file can name a different file namer. 
-#
-if NAMER_MODULE:
-	# Load the module from the given file name and create a 
-	# file namer object.
-	spec = importlib.util.spec_from_file_location("namer", NAMER_MODULE)
-	foo = importlib.util.module_from_spec(spec)
-	spec.loader.exec_module(foo)
-	namer = foo.FileNamer(CONFIG_DATA)
-else:
-	namer = FileNamer(CONFIG_DATA)
+	def __init__(self, R, rate=1.0, burst=5, state=None, metrics=None):
+		self._R = R
+		self._bucket = ratelimit.TokenBucket(rate, burst)
+		self._state = state
+		self._metrics = metrics or Metrics()
+		self._queue = queue.Queue()
+		self._queued = set()
+		self._thread = threading.Thread(target=self._run, name="unsave", daemon=True)
+		self.unsaved = 0
+		# praw is not thread safe.  Hold this around any other use of R
+		# while the queue is running.
+		self.reddit_lock = threading.Lock()
+
+	def start(self):
+		if self._state is not None:
+			# Left over from an earlier run.
+			for (post_id, title) in self._state.pending_unsaves():
+				self._put(post_id, title)
+		self._thread.start()
+
+	def _put(self, post_id, title):
+		if post_id in self._queued:
+			return
+		self._queued.add(post_id)
+		self._queue.put((post_id, title))
+
+	def put(self, post_id, title):
+		if self._state is not None:
+			self._state.queue_unsave(post_id, title)
+		self._put(post_id, title)
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			(post_id, title) = item
+			self._metrics.observe('unsave_wait', self._bucket.acquire())
+			print("Unsaving {}".format(title))
+			try:
+				with self._metrics.timer('unsave'), self.reddit_lock:
+					self._R.submission(id=post_id).unsave()
+			except Exception as ex:
+				# Stays queued in the state store for the next run.
+				print ("    Unsave failed: {}".format(ex))
+				self._metrics.add('unsaves', result='failed')
+				continue
+			self.unsaved += 1
+			self._metrics.add('unsaves', result='ok')
+			if self._state is not None:
+				self._state.unsave_done(post_id)
 
+	def close(self):
+		'''Wait for every queued unsave to be done.'''
+		self._queue.put(None)
+		self._thread.join()
 
 
-# check if dir exists
 
-if not os.path.exists(SAVE_DIR):
-	print ("Save directory '{}' does not exist".format(SAVE_DIR))
-	sys.exit(-1)
+def download_post(sp, context, is_expirmental=False):
+	"""
+	Find a downloader for one saved post and run it with 'context', a
+	DownloadContext.  Returns True if a download was attempted, which is
+	what counts against the limit.  Safe to call from worker threads.
+	"""
+	metrics = context.metrics
+	# delete trailing slash
+	if sp.submission.url.endswith('/'):
+		sp.submission.url = sp.submission.url[0:-1]
+	print (f"{sp.submission.url} : {sp.submission.title}")
+	# create object per submission. Trusting garbage collector!
+	d = make_downloader(sp, context, is_expirmental=is_expirmental)
+	attempted = False
+	if d is None:
+		sp.set_notdone("Domain '{}' not supported".format(sp.submission.domain))
+		name = None
+	else:
+		name = type(d).__name__
+		try:
+			with metrics.timer('download', downloader=name):
+				d.download()
+			attempted = True
+		except Exception as e:
+			print (f"FAILED:  {str(e)}")
+			sp.status_code = sp.STATUS_EXCEPTION
+	metrics.add('posts', downloader=name, status=sp.status_code)
 
-# Using configuration in praw.ini
-#R = praw.Reddit("bot1")
-R = praw.Reddit(user_agent=USER_AGENT, 
-				client_id=CLIENT_ID, client_secret=CLIENT_SECRET, 
-				password=PASSWORD, username=USERNAME)
+	return attempted
 
 
-# Download all known-working types.
-save_posts(R, USERNAME, SAVE_DIR, namer, delay=DELAY, is_unsave=True, limit=0, is_expirmental=True)
 
-# Test expirmental
-#save_posts(R, USERNAME, SAVE_DIR, namer, is_unsave=True, limit=10, is_expirmental=True)
+def save_posts(R, username, save_dir, namer, context=None, limit=0, is_unsave=True, is_expirmental=False,
+			   workers=1, host_limits=None, default_host_limit=0, unsave_rate=1.0, unsave_burst=5,
+			   incremental=False):
+	"""
+	Download the user's saved posts.
+	Parameters:
+		context - DownloadContext with the transport, metrics, state and
+				download settings of this run.  The time spent in each
+				stage is printed at the end.
+		workers - number of posts downloaded at the same time.
+		host_limits - maximum concurrent downloads per host, e.g. { 'redgifs.com': 2 }.
+		default_host_limit - cap for hosts not in host_limits (0 for none).
+		unsave_rate, unsave_burst - pacing of unsaves, in requests per second.
+		incremental - stop listing at the newest posts seen by the last
+				complete run instead of paging through the whole saved
+				list.  Needs context.state.  Posts that failed are listed
+				again until they have had CURSOR_RETRIES attempts.
+	"""
+	print("Logging in...")
+	# create session
+	print (R.user.me())
+	print("Logged in.")
+	print("Getting data...")
+	# this returns a generator which fetches the listing a page at a time,
+	# so posts from the first page are downloading before the next is requested
+	red = R.redditor(username)
+	listing = red.saved(limit=None)
+
+	context = context or DownloadContext()
+	metrics = context.metrics
+	state = context.state
+	context.allocator.scan(save_dir)
+
+	workers = max(1, workers)
+	host_limiter = HostLimiter(host_limits, default_host_limit)
+	pending = set()
+	# Posts waiting for a slot on their host, as (SavedPost, media host,
+	# position, time listed).  Posts for other hosts go ahead of them.
+	held = []
+	max_held = workers * HELD_POSTS_PER_WORKER
+	found = 0
+	skipped = 0
+	count = 0
+	# Only what is needed after the downloads is kept, so memory does not
+	# grow with the length of the saved list.
+	failed = []
+
+	# The newest posts listed by the last complete run.  An incremental
+	# run stops when it gets to one of them.
+	cursor_key = 'saved_cursor:' + username
+	cursor = state.get_meta(cursor_key, []) if state is not None else []
+	stop_at = set(cursor) if incremental else set()
+	if incremental and state is None:
+		print ("Incremental listing needs a state store, listing everything.")
+	# (position, fullname) of posts listed after every failure still worth
+	# retrying, for the next run to stop at.
+	next_cursor = []
+	complete = False
+	reached = False
+
+	# Posts are unsaved in the background as soon as they are downloaded.
+	unsaver = None
+	reddit_lock = contextlib.nullcontext()
+	if is_unsave:
+		unsaver = UnsaveQueue(R, unsave_rate, unsave_burst, state, metrics)
+		reddit_lock = unsaver.reddit_lock
+		unsaver.start()
+
+	def collect():
+		# Wait for at least one running download and report it.
+		nonlocal count, next_cursor
+		(done, _) = wait(pending, return_when=FIRST_COMPLETED)
+		for f in done:
+			pending.remove(f)
+			(sp, attempted, position) = f.result()
+			if attempted:
+				count += 1
+			print (f"    Status: {sp.status_code} : {sp.error_message}")
+			for (path, original) in sp.duplicates:
+				print (f"    Duplicate: {path} of {original}")
+			if state is not None:
+				state.record(sp.submission.id, sp.status_code, sp.saved_path, sp.error_message, sp.duplicates)
+			if sp.is_saved:
+				if unsaver is not None:
+					unsaver.put(sp.submission.id, sp.submission.title)
+			else:
+				failed.append((sp.submission.title, sp.status_code, sp.error_message))
+				if sp.status_code != sp.STATUS_NOTDONE and state is not None \
+						and state.get(sp.submission.id)['attempts'] < CURSOR_RETRIES:
+					# The next run has to list this post again.
+					next_cursor = [ c for c in next_cursor if c[0] > position ]
+
+	def run(sp, host, position):
+		# The host slot was taken by dispatch().
+		try:
+			return (sp, download_post(sp, context, is_expirmental), position)
+		finally:
+			host_limiter.release(host)
+
+	def dispatch():
+		# Start held back posts whose host has a free slot, oldest first.
+		for item in list(held):
+			if len(pending) >= workers:
+				break
+			(sp, host, position, since) = item
+			if host_limiter.try_acquire(host):
+				held.remove(item)
+				metrics.observe('host_slot_wait', time.perf_counter() - since, domain=host)
+				pending.add(pool.submit(run, sp, host, position))
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		# Check the limit before asking for the next post so that paging
+		# stops as soon as enough have been downloaded.
+		while not (limit > 0 and count >= limit):
+			with metrics.timer('listing'), reddit_lock:
+				x = next(listing, None)
+			if x is None:
+				complete = True
+				break
+			if x.name in stop_at:
+				print ("Reached the posts listed by the last run.")
+				complete = reached = True
+				break
+			found += 1
+			metrics.add('posts_found')
+			if len(next_cursor) < CURSOR_DEPTH:
+				next_cursor.append((found, x.name))
+			if state is not None and state.is_done(x.id):
+				# Downloaded by an earlier run.  It is still in the saved list
+				# so that run did not get as far as unsaving it.
+				skipped += 1
+				metrics.add('posts_skipped')
+				if unsaver is not None:
+					unsaver.put(x.id, x.title)
+				continue
+			sp = SavedPost(x, save_dir, namer)
+			if state is not None:
+				state.begin(x.id)
+			held.append((sp, media_host(sp, is_expirmental), found, time.perf_counter()))
+			dispatch()
+			# Keep no more than one post per worker in flight, no more than
+			# max_held waiting for busy hosts, and never more than could
+			# still count towards the limit.
+			while pending and (len(pending) >= workers or len(held) >= max_held
+							   or (limit > 0 and count + len(pending) + len(held) >= limit)):
+				collect()
+				dispatch()
+		while pending or held:
+			if pending:
+				collect()
+			dispatch()
+
+	if complete and state is not None:
+		# Everything newer than the old cursor has been seen.  Stopping
+		# early for the limit leaves the cursor where it was.
+		names = [ name for (_, name) in next_cursor ]
+		if reached:
+			names += [ name for name in cursor if name not in names ]
+		state.set_meta(cursor_key, names[:CURSOR_DEPTH])
+
+	print ("{} posts found".format(found))
+	if skipped:
+		print ("{} already downloaded.".format(skipped))
+	print("{} processed.".format(count))
 
-#save_posts(R, USERNAME, SAVE_DIR, namer, is_unsave=True, limit=1, is_expirmental=True)
\ No newline at end of file
+	if unsaver is not None:
+		with metrics.timer('unsave_drain'):
+			unsaver.close()
+		print("{} unsaved.".format(unsaver.unsaved))
+
+	for (title, status_code, error_message) in failed:
+		print ("{1}: {2} - {0}".format(title, status_code, error_message))
+
+	metrics.report()
+
+
+
+
+
+if __name__ == '__main__':
+	CONFIG = open('config-mopaitai.yaml')
+	CONFIG_DATA = yaml.safe_load(CONFIG)
+	# user data
+	USERNAME = CONFIG_DATA['username']
+	PASSWORD = CONFIG_DATA['password']
+	CLIENT_ID = CONFIG_DATA['client_id']
+	CLIENT_SECRET = CONFIG_DATA['client_secret']
+	USER_AGENT = CONFIG_DATA['user_agent']
+	FOLLOWING = CONFIG_DATA['following']
+	SAVE_DIR = os.path.expanduser(CONFIG_DATA['save_dir'])
+	NAMER_MODULE = CONFIG_DATA['namer_module']
+	STATE_DB = os.path.expanduser(CONFIG_DATA.get('state_db', os.path.join(SAVE_DIR, '.reddit-saved.sqlite')))
+	DEDUP = CONFIG_DATA.get('dedup', 'link')
+	WORKERS = CONFIG_DATA.get('workers', 1)
+	HTTP_CONFIG = CONFIG_DATA.get('http', {})
+	UNSAVE_RATE = CONFIG_DATA.get('unsave_rate', 1.0)
+	UNSAVE_BURST = CONFIG_DATA.get('unsave_burst', 5)
+	SEGMENTS = CONFIG_DATA.get('segments', 4)
+	SEGMENT_THRESHOLD_MB = CONFIG_DATA.get('segment_threshold_mb', 32)
+	RESOLVE_CACHE = CONFIG_DATA.get('resolve_cache', {})
+	RATE_LIMITS = dict(CONFIG_DATA.get('rate_limits') or {})
+	DEFAULT_RATE_LIMIT = RATE_LIMITS.pop('default', None)
+	if DEFAULT_RATE_LIMIT is None and CONFIG_DATA.get('delay'):
+		# Older configs paced everything with one fixed delay.
+		DEFAULT_RATE_LIMIT = { 'rate': 1.0 / CONFIG_DATA['delay'], 'burst': 1 }
+	# Reddit's own pages are fetched slowly unless configured otherwise.
+	RATE_LIMITS.setdefault('reddit.com', { 'rate': 0.5, 'burst': 1 })
+	HOST_LIMITS = CONFIG_DATA.get('host_limits', {})
+	DEFAULT_HOST_LIMIT = CONFIG_DATA.get('default_host_limit', 0)
+	METRICS_CONFIG = CONFIG_DATA.get('metrics') or {}
+	DOWNLOADER_MODULES = CONFIG_DATA.get('downloader_modules') or []
+	RENDITIONS = CONFIG_DATA.get('renditions') or {}
+	WRITE_BUFFER_KB = CONFIG_DATA.get('write_buffer_kb', 1024)
+	PREALLOCATE = CONFIG_DATA.get('preallocate', True)
+	INCREMENTAL = CONFIG_DATA.get('incremental', False)
+
+	#
+	# Config file can name a different file namer. 
+	#
+	if NAMER_MODULE:
+		# Load the module from the given file name and create a 
+		# file namer object.
+		spec = importlib.util.spec_from_file_location("namer", NAMER_MODULE)
+		foo = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(foo)
+		namer = foo.FileNamer(CONFIG_DATA)
+	else:
+		namer = FileNamer(CONFIG_DATA)
+
+	#
+	# Downloaders for more sites can come from other files too.  Each entry
+	# is a file name, or { path: file, domains: [...] } to load it only when
+	# a post for one of those domains turns up.
+	#
+	for entry in DOWNLOADER_MODULES:
+		if isinstance(entry, str):
+			entry = { 'path': entry }
+		DOWNLOADERS.add_module(os.path.expanduser(entry['path']), entry.get('domains'))
+
+
+
+	# check if dir exists
+
+	if not os.path.exists(SAVE_DIR):
+		print ("Save directory '{}' does not exist".format(SAVE_DIR))
+		sys.exit(-1)
+
+	state = statestore.StateStore(STATE_DB, done_status=SavedPost.STATUS_SAVED)
+	metrics = Metrics()
+	transport = Transport(pool_size=HTTP_CONFIG.get('pool_size', pool_size_for(WORKERS, SEGMENTS)),
+						  host_pool_sizes=HTTP_CONFIG.get('host_pool_sizes'),
+						  timeout=tuple(HTTP_CONFIG.get('timeout', (10, 60))),
+						  limiter=ratelimit.RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT),
+						  metrics=metrics)
+	METRICS_JSON = METRICS_CONFIG.get('json')
+	METRICS_PROMETHEUS = METRICS_CONFIG.get('prometheus')
+	if METRICS_CONFIG.get('live_interval'):
+		metrics.start_live(METRICS_CONFIG['live_interval'],
+						   os.path.expanduser(METRICS_PROMETHEUS) if METRICS_PROMETHEUS else None)
+
+	# Using configuration in praw.ini
+	#R = praw.Reddit("bot1")
+	R = praw.Reddit(user_agent=USER_AGENT, 
+					client_id=CLIENT_ID, client_secret=CLIENT_SECRET, 
+					password=PASSWORD, username=USERNAME)
+
+
+	context = DownloadContext(transport=transport, metrics=metrics, state=state, dedup=DEDUP,
+							  segments=SEGMENTS, segment_threshold_mb=SEGMENT_THRESHOLD_MB,
+							  resolve_ttl_days=RESOLVE_CACHE.get('ttl_days', 7),
+							  resolve_max_entries=RESOLVE_CACHE.get('max_entries', 50000),
+							  rendition_policy=RENDITIONS.get('policy', 'best'),
+							  rendition_max_mb=RENDITIONS.get('max_mb', 0),
+							  rendition_max_height=RENDITIONS.get('max_height', 0),
+							  write_buffer_kb=WRITE_BUFFER_KB, preallocate=PREALLOCATE)
+
+	# Download all known-working types.
+	save_posts(R, USERNAME, SAVE_DIR, namer, context, is_unsave=True, limit=0, is_expirmental=True,
+			   workers=WORKERS, host_limits=HOST_LIMITS, default_host_limit=DEFAULT_HOST_LIMIT,
+			   unsave_rate=UNSAVE_RATE, unsave_burst=UNSAVE_BURST, incremental=INCREMENTAL)
+
+	metrics.stop_live()
+	if METRICS_JSON:
+		metrics.write_json(os.path.expanduser(METRICS_JSON))
+	if METRICS_PROMETHEUS:
+		metrics.write_prometheus(os.path.expanduser(METRICS_PROMETHEUS))
+
+	# Test expirmental
+	#save_posts(R, USERNAME, SAVE_DIR, namer, is_unsave=True, limit=10, is_expirmental=True)
+
+	#save_posts(R, USERNAME, SAVE_DIR, namer, is_unsave=True, limit=1, is_expirmental=True)
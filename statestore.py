@@ -0,0 +1,218 @@
+"""
+Persistent record of what has been downloaded so that an interrupted run
+only has to do the work that is left.
+"""
+import os
+import json
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+	id TEXT PRIMARY KEY,
+	status INTEGER NOT NULL DEFAULT 0,
+	saved_path TEXT NOT NULL DEFAULT '',
+	error TEXT NOT NULL DEFAULT '',
+	duplicates TEXT NOT NULL DEFAULT '',
+	attempts INTEGER NOT NULL DEFAULT 0,
+	first_seen REAL NOT NULL,
+	updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+	digest TEXT PRIMARY KEY,
+	path TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resolved (
+	page_url TEXT PRIMARY KEY,
+	media_urls TEXT NOT NULL,
+	created REAL NOT NULL,
+	used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resolved_used ON resolved (used);
+CREATE TABLE IF NOT EXISTS files (
+	url TEXT PRIMARY KEY,
+	path TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	etag TEXT,
+	last_modified TEXT,
+	updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unsaves (
+	id TEXT PRIMARY KEY,
+	title TEXT NOT NULL DEFAULT '',
+	queued REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL,
+	updated REAL NOT NULL
+);
+"""
+
+
+class StateStore(object):
+	'''SQLite backed download status for each submission, keyed by id.
+
+	The ids of finished posts are loaded once when the store is opened so
+	that is_done() is a set lookup.  All writes go through one connection
+	guarded by a lock, so the store can be shared by worker threads.
+	'''
+
+	def __init__(self, path, done_status=1):
+		self.path = path
+		self._done_status = done_status
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+		self._db.executescript(SCHEMA)
+		columns = set(row[1] for row in self._db.execute("PRAGMA table_info(posts)"))
+		if 'duplicates' not in columns:
+			# Made before duplicates were recorded.
+			self._db.execute("ALTER TABLE posts ADD COLUMN duplicates TEXT NOT NULL DEFAULT ''")
+		self._done = set(row[0] for row in
+						 self._db.execute("SELECT id FROM posts WHERE status = ?", (done_status,)))
+		self._resolved_count = self._db.execute("SELECT COUNT(*) FROM resolved").fetchone()[0]
+
+	def is_done(self, post_id):
+		return post_id in self._done
+
+	def begin(self, post_id):
+		'''Note that a download of the post is being attempted.'''
+		now = time.time()
+		with self._lock, self._db:
+			self._db.execute(
+				"INSERT INTO posts (id, attempts, first_seen, updated) VALUES (?, 1, ?, ?) "
+				"ON CONFLICT(id) DO UPDATE SET attempts = attempts + 1, updated = excluded.updated",
+				(post_id, now, now))
+
+	def record(self, post_id, status, saved_path="", error="", duplicates=()):
+		'''Store the outcome of a download attempt.  'duplicates' are the
+		(path, original path) pairs of content that had been saved before,
+		kept as a JSON list.'''
+		now = time.time()
+		duplicates = json.dumps([ list(d) for d in duplicates ]) if duplicates else ""
+		with self._lock, self._db:
+			self._db.execute(
+				"INSERT INTO posts (id, status, saved_path, error, duplicates, first_seen, updated) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?) "
+				"ON CONFLICT(id) DO UPDATE SET status = excluded.status, saved_path = excluded.saved_path, "
+				"error = excluded.error, duplicates = excluded.duplicates, updated = excluded.updated",
+				(post_id, status, saved_path or "", str(error or ""), duplicates, now, now))
+			if status == self._done_status:
+				self._done.add(post_id)
+			else:
+				self._done.discard(post_id)
+
+	def get(self, post_id):
+		'''Return the stored row for a post as a dict, or None.'''
+		with self._lock:
+			cur = self._db.execute(
+				"SELECT id, status, saved_path, error, duplicates, attempts, first_seen, updated FROM posts WHERE id = ?",
+				(post_id,))
+			row = cur.fetchone()
+		if row is None:
+			return None
+		return dict(zip([ d[0] for d in cur.description ], row))
+
+	def claim_hash(self, digest, path, size):
+		'''Find content already saved with this hash.
+
+		Returns the path of the earlier copy if it is still on disk with
+		the size it was recorded with.  Otherwise 'path' becomes the copy on
+		record and None is returned.
+		Checking and claiming happen under one lock, so two workers saving
+		the same content at once cannot both become the original.
+		'''
+		with self._lock, self._db:
+			row = self._db.execute("SELECT path, size FROM hashes WHERE digest = ?", (digest,)).fetchone()
+			if row is not None and os.path.isfile(row[0]) and os.path.getsize(row[0]) == row[1]:
+				return row[0]
+			self._db.execute("INSERT OR REPLACE INTO hashes (digest, path, size, created) VALUES (?, ?, ?, ?)",
+							 (digest, path, size, time.time()))
+		return None
+
+	def get_file(self, url):
+		'''What was recorded when url was last downloaded, as a dict, or None.'''
+		with self._lock:
+			row = self._db.execute("SELECT path, size, etag, last_modified FROM files WHERE url = ?",
+								   (url,)).fetchone()
+		if row is None:
+			return None
+		return dict(zip(('path', 'size', 'etag', 'last_modified'), row))
+
+	def put_file(self, url, path, size, etag=None, last_modified=None):
+		with self._lock, self._db:
+			self._db.execute("INSERT OR REPLACE INTO files (url, path, size, etag, last_modified, updated) "
+							 "VALUES (?, ?, ?, ?, ?, ?)", (url, path, size, etag, last_modified, time.time()))
+
+	def get_resolved(self, page_url, ttl):
+		'''Media URLs page_url was resolved to less than ttl seconds ago, or None.'''
+		now = time.time()
+		with self._lock, self._db:
+			row = self._db.execute("SELECT media_urls, created FROM resolved WHERE page_url = ?",
+								   (page_url,)).fetchone()
+			if row is None or row[1] < now - ttl:
+				return None
+			self._db.execute("UPDATE resolved SET used = ? WHERE page_url = ?", (now, page_url))
+		return json.loads(row[0])
+
+	def put_resolved(self, page_url, media_urls, max_entries):
+		'''Remember what page_url resolved to.  Past max_entries the least
+		recently used answers are dropped.'''
+		now = time.time()
+		with self._lock, self._db:
+			cur = self._db.execute("INSERT OR IGNORE INTO resolved (page_url, media_urls, created, used) VALUES (?, ?, ?, ?)",
+								   (page_url, json.dumps(media_urls), now, now))
+			if cur.rowcount == 0:
+				self._db.execute("UPDATE resolved SET media_urls = ?, created = ?, used = ? WHERE page_url = ?",
+								 (json.dumps(media_urls), now, now, page_url))
+			else:
+				self._resolved_count += 1
+			if self._resolved_count > max_entries:
+				# Evict a little more than needed so this does not run every time.
+				excess = self._resolved_count - max_entries + max(1, max_entries // 100)
+				cur = self._db.execute("DELETE FROM resolved WHERE page_url IN "
+									   "(SELECT page_url FROM resolved ORDER BY used LIMIT ?)", (excess,))
+				self._resolved_count -= cur.rowcount
+
+	def drop_resolved(self, page_url):
+		with self._lock, self._db:
+			cur = self._db.execute("DELETE FROM resolved WHERE page_url = ?", (page_url,))
+			self._resolved_count -= cur.rowcount
+
+	def queue_unsave(self, post_id, title=""):
+		'''Remember that a post still has to be unsaved.'''
+		with self._lock, self._db:
+			self._db.execute("INSERT OR IGNORE INTO unsaves (id, title, queued) VALUES (?, ?, ?)",
+							 (post_id, title, time.time()))
+
+	def unsave_done(self, post_id):
+		with self._lock, self._db:
+			self._db.execute("DELETE FROM unsaves WHERE id = ?", (post_id,))
+
+	def pending_unsaves(self):
+		'''Return (id, title) for posts queued for unsave but not done,
+		oldest first.'''
+		with self._lock:
+			return self._db.execute("SELECT id, title FROM unsaves ORDER BY queued").fetchall()
+
+	def get_meta(self, key, default=None):
+		'''A value stored with set_meta(), or default.'''
+		with self._lock:
+			row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+		return default if row is None else json.loads(row[0])
+
+	def set_meta(self, key, value):
+		'''Keep any JSON-able value under key.'''
+		with self._lock, self._db:
+			self._db.execute("INSERT OR REPLACE INTO meta (key, value, updated) VALUES (?, ?, ?)",
+							 (key, json.dumps(value), time.time()))
+
+	def close(self):
+		with self._lock:
+			self._db.close()
@@ -0,0 +1,131 @@
+"""
+The saved listing cursor of incremental runs: a run stops at the posts
+the last complete run listed, a failed post keeps the cursor from moving
+past it for CURSOR_RETRIES attempts, and a run cut short by the limit
+leaves the cursor alone.
+
+	python -m unittest discover -b tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import script
+import statestore
+
+
+class Obj(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+class FakeReddit(object):
+	'''The saved list, newest first, and how much of it was read.'''
+
+	def __init__(self, count):
+		self.posts = [ self.post(n) for n in range(count) ]
+		self.listed = 0
+		self.user = Obj(me=lambda: 'tester')
+
+	def post(self, n):
+		return Obj(id='p{}'.format(n), name='t3_p{}'.format(n), title='post {}'.format(n),
+				   url='https://i.redd.it/{}.jpg'.format(n), domain='i.redd.it')
+
+	def save_new(self, count):
+		'''Posts saved since, which go to the top of the list.'''
+		start = len(self.posts)
+		new = [ self.post(n) for n in range(start, start + count) ]
+		self.posts[:0] = reversed(new)
+		return new
+
+	def redditor(self, name):
+		return Obj(saved=self.saved)
+
+	def saved(self, limit=None):
+		for post in self.posts:
+			self.listed += 1
+			yield post
+
+
+class Namer(object):
+	def name_for(self, submission):
+		return submission.id
+
+
+class CursorTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='test-cursor-')
+		self.state = statestore.StateStore(os.path.join(self.dir, 'state.sqlite'),
+										   done_status=script.SavedPost.STATUS_SAVED)
+		self.reddit = FakeReddit(50)
+		self.failing = set()
+		self.downloaded = []
+		self.real_download_post = script.download_post
+		script.download_post = self.download_post
+
+	def tearDown(self):
+		script.download_post = self.real_download_post
+		self.state.close()
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def download_post(self, sp, context, is_expirmental=False):
+		self.downloaded.append(sp.submission.id)
+		if sp.submission.id in self.failing:
+			sp.set_error("failed")
+		else:
+			sp.set_saved(os.path.join(self.dir, sp.submission.id))
+		return True
+
+	def run_once(self, limit=0):
+		'''One incremental run.  Returns (posts listed, posts downloaded).'''
+		(self.reddit.listed, self.downloaded) = (0, [])
+		context = script.DownloadContext(state=self.state)
+		try:
+			script.save_posts(self.reddit, 'tester', self.dir, Namer(), context, limit=limit,
+							  is_unsave=False, workers=2, incremental=True)
+		finally:
+			context.transport.close()
+		return (self.reddit.listed, sorted(self.downloaded))
+
+	def cursor(self):
+		return self.state.get_meta('saved_cursor:tester')
+
+	def test_stops_at_last_run(self):
+		self.assertEqual(self.run_once()[0], 50)
+		self.assertEqual(len(self.cursor()), script.CURSOR_DEPTH)
+		# Nothing new: only the first post is read.
+		self.assertEqual(self.run_once(), (1, []))
+		new = self.reddit.save_new(3)
+		self.assertEqual(self.run_once(), (4, sorted(p.id for p in new)))
+		self.assertEqual(self.cursor()[0], new[-1].name)
+
+	def test_failed_post_is_listed_again(self):
+		self.run_once()
+		new = self.reddit.save_new(5)
+		self.failing.add(new[1].id)
+		self.run_once()
+		for attempt in range(2, script.CURSOR_RETRIES + 1):
+			# The cursor stays below the failure, so it is tried again.
+			(listed, downloaded) = self.run_once()
+			self.assertEqual(downloaded, [ new[1].id ], attempt)
+			self.assertEqual(self.state.get(new[1].id)['attempts'], attempt)
+		# Out of retries: the cursor moves past it.
+		self.run_once()
+		self.assertEqual(self.run_once(), (1, []))
+
+	def test_limit_keeps_cursor(self):
+		self.run_once()
+		cursor = self.cursor()
+		self.reddit.save_new(10)
+		self.assertEqual(len(self.run_once(limit=4)[1]), 4)
+		self.assertEqual(self.cursor(), cursor)
+		# The rest are found next time, and listing stops at the old cursor.
+		self.assertEqual(self.run_once(), (11, sorted('p{}'.format(n) for n in range(50, 56))))
+
+
+if __name__ == '__main__':
+	unittest.main()
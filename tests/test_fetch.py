@@ -0,0 +1,204 @@
+"""
+Downloads against a local http.server: resuming a .part left by an
+interrupted run, a file that changed since (If-Range), a .part the server
+says it cannot continue (416), a preallocated .part whose record is behind
+its size, and sniffing of segmented fetches.
+
+	python -m unittest discover -b tests
+"""
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import script
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	'''Serves server.body with server.etag, honouring Range and If-Range.
+	server.cut_after ends the first full response after that many bytes.'''
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def do_HEAD(self):
+		self._reply(head=True)
+
+	def do_GET(self):
+		self._reply(head=False)
+
+	def _reply(self, head):
+		server = self.server
+		body = server.body
+		server.requests.append((self.command, self.headers.get('Range'), self.headers.get('If-Range')))
+		(status, start, end) = (200, 0, len(body) - 1)
+		wanted = self.headers.get('Range')
+		if wanted and self.headers.get('If-Range', server.etag) == server.etag:
+			(first, _, last) = wanted[len('bytes='):].partition('-')
+			(start, end) = (int(first), int(last) if last else len(body) - 1)
+			if start >= len(body):
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			status = 206
+		self.send_response(status)
+		self.send_header('Content-Type', server.content_type)
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('ETag', server.etag)
+		self.send_header('Content-Length', str(end - start + 1))
+		if status == 206:
+			self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(body)))
+		self.end_headers()
+		if head:
+			return
+		part = body[start:end + 1]
+		if status == 200 and server.cut_after is not None:
+			(part, server.cut_after) = (part[:server.cut_after], None)
+			self.close_connection = True
+		self.wfile.write(part)
+
+
+class Server(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# The client hanging up on a page it gave up on.
+		pass
+
+
+class Namer(object):
+	def name_for(self, submission):
+		return 'post'
+
+
+class Obj(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+
+class FetchTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.server = Server(('127.0.0.1', 0), Handler)
+		self.server.body = b'\xff\xd8\xff\xe0' + os.urandom(300 * 1024)
+		self.server.etag = '"v1"'
+		self.server.content_type = 'image/jpeg'
+		self.server.cut_after = None
+		self.server.requests = []
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = 'http://127.0.0.1:{}/media.jpg'.format(self.server.server_port)
+		self.dir = tempfile.mkdtemp(prefix='test-fetch-')
+		self.path = os.path.join(self.dir, 'post.jpg')
+		self.part = self.path + script.PART_SUFFIX
+		self.context = script.DownloadContext(write_buffer_kb=64)
+
+	def tearDown(self):
+		self.context.transport.close()
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def downloader(self, url=None):
+		submission = Obj(url=url or self.url, domain='127.0.0.1', title='post', id='t1',
+						 subreddit=Obj(display_name='test'))
+		return script.DirectDownloader(script.SavedPost(submission, self.dir, Namer()), self.context)
+
+	def leave_part(self, data, received, etag='"v1"', size=None):
+		'''The .part and record an interrupted run leaves behind.'''
+		with open(self.part, 'wb') as f:
+			f.write(data)
+			if size is not None:
+				f.truncate(size)
+		with open(self.part + script.PART_INFO_SUFFIX, 'w') as f:
+			json.dump({ 'url': self.url, 'etag': etag, 'last_modified': None, 'received': received }, f)
+
+	def fetch(self):
+		saved = self.downloader()._download_to_path(self.url, self.path)
+		with open(saved, 'rb') as f:
+			self.assertEqual(f.read(), self.server.body)
+		self.assertFalse(os.path.exists(self.part))
+		self.assertFalse(os.path.exists(self.part + script.PART_INFO_SUFFIX))
+		return [ r for r in self.server.requests if r[0] == 'GET' ]
+
+	def test_fresh(self):
+		self.assertEqual(self.fetch(), [ ('GET', None, None) ])
+
+	def test_resume_after_interrupt(self):
+		half = len(self.server.body) // 2
+		self.leave_part(self.server.body[:half], half)
+		self.assertEqual(self.fetch(), [ ('GET', 'bytes={}-'.format(half), '"v1"') ])
+
+	def test_resume_within_run(self):
+		# The first response breaks off; the retry asks for the rest of
+		# what reached the file.
+		self.server.cut_after = 100 * 1024
+		requests = self.fetch()
+		self.assertEqual(len(requests), 2)
+		(_, wanted, validator) = requests[1]
+		self.assertTrue(0 < int(wanted[len('bytes='):-1]) <= 100 * 1024)
+		self.assertEqual(validator, '"v1"')
+
+	def test_if_range_mismatch(self):
+		# The file changed since the .part was written.  The server sends
+		# all of the new one and none of the old data may be kept.
+		half = len(self.server.body) // 2
+		self.leave_part(os.urandom(half), half, etag='"v0"')
+		self.assertEqual(self.fetch(), [ ('GET', 'bytes={}-'.format(half), '"v0"') ])
+
+	def test_range_not_satisfiable(self):
+		# More than the server has: 416, then a fresh fetch.
+		size = len(self.server.body) + 10
+		self.leave_part(os.urandom(size), size)
+		self.assertEqual(self.fetch(), [ ('GET', 'bytes={}-'.format(size), '"v1"'), ('GET', None, None) ])
+
+	def test_preallocated_part(self):
+		# A killed run leaves the file at full size with only the start
+		# recorded.  Data past the record is not trusted.
+		body = self.server.body
+		(written, recorded) = (200 * 1024, 120 * 1024)
+		self.leave_part(body[:written], recorded, size=len(body))
+		self.assertEqual(self.fetch(), [ ('GET', 'bytes={}-'.format(recorded), '"v1"') ])
+
+	def test_page_is_not_media(self):
+		self.server.body = b'<!DOCTYPE html><html>' + b' ' * 1024
+		self.server.content_type = 'image/jpeg'
+		with self.assertRaises(script.NotMedia):
+			self.downloader()._download_to_path(self.url, self.path)
+		self.assertFalse(os.path.exists(self.part))
+
+	def test_segmented(self):
+		self.server.body = b'\x00\x00\x00\x18ftypmp42' + os.urandom(400 * 1024)
+		self.server.content_type = 'video/mp4'
+		self.context.segment_threshold = 64 * 1024
+		url = self.url.replace('.jpg', '.mp4')
+		saved = self.downloader(url)._download_to_path(url, self.path.replace('.jpg', '.mp4'))
+		with open(saved, 'rb') as f:
+			self.assertEqual(hashlib.sha256(f.read()).digest(), hashlib.sha256(self.server.body).digest())
+		ranges = [ r for r in self.server.requests if r[0] == 'GET' ]
+		self.assertEqual(len(ranges), self.context.segment_count)
+
+	def test_segmented_page_is_not_media(self):
+		# Sniffed from the first range, before the .part is made.
+		self.server.body = b'<html>' + b' ' * (400 * 1024)
+		self.server.content_type = 'video/mp4'
+		self.context.segment_threshold = 64 * 1024
+		url = self.url.replace('.jpg', '.mp4')
+		path = self.path.replace('.jpg', '.mp4')
+		with self.assertRaises(script.NotMedia):
+			self.downloader(url)._download_to_path(url, path)
+		self.assertFalse(os.path.exists(path + script.PART_SUFFIX))
+		self.assertEqual(len([ r for r in self.server.requests if r[0] == 'GET' ]), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,118 @@
+"""
+sniff_media() and NameAllocator.
+
+	python -m unittest discover -b tests
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import script
+
+
+class SniffTestCase(unittest.TestCase):
+
+	def test_magic_numbers(self):
+		self.assertEqual(script.sniff_media('image/jpeg', b'\xff\xd8\xff\xe0rest'), 'jpg')
+		self.assertEqual(script.sniff_media(None, b'\x89PNG\r\n\x1a\nrest'), 'png')
+		self.assertEqual(script.sniff_media('video/mp4', b'\x00\x00\x00\x18ftypmp42'), 'mp4')
+		self.assertEqual(script.sniff_media('image/webp', b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'webp')
+
+	def test_bytes_win_over_content_type(self):
+		# Servers that send everything as octet-stream, or as a page.
+		self.assertEqual(script.sniff_media('application/octet-stream', b'GIF89a'), 'gif')
+		self.assertEqual(script.sniff_media('text/html', b'\xff\xd8\xff\xe0'), 'jpg')
+
+	def test_pages(self):
+		for (ctype, head) in (('text/html; charset=utf-8', b'\x00\x01'),
+							  ('application/json', b'\x00\x01'),
+							  ('image/jpeg', b'<!DOCTYPE html><html>'),
+							  ('video/mp4', b'\xef\xbb\xbf\n  <html>'),
+							  ('application/octet-stream', b'{"error": "gone"}')):
+			with self.assertRaises(script.NotMedia, msg=ctype):
+				script.sniff_media(ctype, head)
+
+	def test_unknown_media(self):
+		self.assertEqual(script.sniff_media('video/x-unknown', b'\x00\x01\x02\x03'), '')
+		self.assertEqual(script.sniff_media('image/svg+xml', b'<svg/>'), 'svg')
+
+	def test_read_head(self):
+		# Short reads are put together up to SNIFF_SIZE and no further.
+		class Trickle(io.RawIOBase):
+			def __init__(self, data):
+				self.data = io.BytesIO(data)
+
+			def readinto(self, buffer):
+				return self.data.readinto(buffer[:7])
+
+		buffer = memoryview(bytearray(4096))
+		self.assertEqual(script.read_head(Trickle(b'x' * 2000), buffer), script.SNIFF_SIZE)
+		self.assertEqual(script.read_head(Trickle(b'x' * 20), buffer), 20)
+
+
+class NameAllocatorTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp(prefix='test-names-')
+		self.allocator = script.NameAllocator()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def path(self, name):
+		return os.path.join(self.dir, name)
+
+	def touch(self, *names):
+		for name in names:
+			open(self.path(name), 'w').close()
+
+	def test_free_name(self):
+		self.assertEqual(self.allocator.allocate(self.path('a.jpg')), self.path('a.jpg'))
+
+	def test_numbered_after_existing(self):
+		self.touch('a.jpg', 'a_01.jpg', 'a_07.jpg', 'b.jpg')
+		self.assertEqual(self.allocator.allocate(self.path('a.jpg')), self.path('a_08.jpg'))
+		self.assertEqual(self.allocator.allocate(self.path('a.jpg')), self.path('a_09.jpg'))
+		self.assertEqual(self.allocator.allocate(self.path('a.png')), self.path('a.png'))
+
+	def test_reserved_when_given_out(self):
+		first = self.allocator.allocate(self.path('a.jpg'))
+		self.assertEqual(self.allocator.allocate(self.path('a.jpg')), self.path('a_01.jpg'))
+		self.allocator.release(first)
+		self.assertEqual(self.allocator.allocate(self.path('a.jpg')), first)
+
+	def test_parts_do_not_count(self):
+		self.touch('a.mp4.part', 'a.mp4.part.json')
+		self.assertEqual(self.allocator.allocate(self.path('a.mp4')), self.path('a.mp4'))
+
+	def test_listed_once(self):
+		self.allocator.allocate(self.path('a.jpg'))
+		# Appeared behind its back: only names it handed out are known.
+		self.touch('c.jpg')
+		self.assertEqual(self.allocator.allocate(self.path('c.jpg')), self.path('c.jpg'))
+
+	def test_threads_get_different_names(self):
+		names = []
+		lock = threading.Lock()
+
+		def take():
+			for _ in range(50):
+				name = self.allocator.allocate(self.path('a.jpg'))
+				with lock:
+					names.append(name)
+
+		threads = [ threading.Thread(target=take) for _ in range(8) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(len(set(names)), 400)
+
+
+if __name__ == '__main__':
+	unittest.main()